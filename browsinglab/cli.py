@@ -40,3 +40,17 @@ def install(native_name="browsinglab.connector"):
     click.secho("  %s" % filename, bold=True)
     click.echo("Script located in:")
     click.secho("  %s" % script_location, bold=True)
+
+
+@cli.command()
+@click.argument("archive", required=False)
+@click.option("--days", type=int, help="Only include the last DAYS days that have metrics")
+def metrics(archive=None, days=None):
+    """Show the connector's per-handler metrics for an archive (default: all archives)"""
+    from pha.metrics import load_metrics, format_metrics
+    from . import connlist
+    locations = [archive] if archive else connlist.get_locations()
+    for location in locations:
+        click.secho(location, bold=True)
+        data = load_metrics(os.path.join(location, "metrics.json"))
+        click.echo(format_metrics(data, days=days) if data else "No metrics saved yet")
@@ -3,21 +3,31 @@ Implements saving information into the database/files
 """
 
 import os
-import re
-import json
 import sys
-import struct
 import time
-import pprint
 import traceback
 import uuid
 import atexit
+from sqlobject import sqlhub
 from .db import Page, Archive, Activity, ActivityLink, Browser, BrowserSession
 from . import connlist
+# These are shared with the pha saver (install it from python/):
+from pha.logwriter import get_log_writer, describe_message, LEVELS
+from pha.dispatcher import Dispatcher
+from pha import recording
+from pha import frames
+from pha.metrics import Metrics
 
 message_handlers = {}
 
 active_archive = None
+# Set by connect() if $BROWSINGLAB_RECORD_MESSAGES is set (see pha.recording):
+recorder = None
+# Every message is described on stderr only when $BROWSINGLAB_LOG_LEVEL is debug:
+DEFAULT_LEVEL = os.environ.get("BROWSINGLAB_LOG_LEVEL", "log")
+log_messages = LEVELS[DEFAULT_LEVEL] <= LEVELS["debug"]
+# SQLObject doesn't let us time queries, so dbTime stays 0:
+metrics = Metrics()
 active_browser = None
 
 @atexit.register
@@ -105,15 +115,24 @@ def add_activity_list(archive, *, browserId, sessionId, activityItems):
         activity["sourceID"] = Activity.getID(activity.pop("sourceId", None), default=None)
         activity["initialLoadID"] = Activity.getID(activity.pop("initialLoadId", None), default=None)
         a = Activity.replaceUuid(uuid, **activity)
-        log(archive, a)
+        log(archive, a, level="debug")
         ActivityLink.deleteMany(ActivityLink.activity==a)
         for link in linkInformation or []:
-            link = ActivityLink(**link)
+            ActivityLink(
+                activityID=a.id, url=link["url"], text=link["text"],
+                rel=link.get("rel"), target=link.get("target"), elementId=link.get("elementId"))
 
 
 @addon
 def check_page_needed(archive, url):
-    return Page.urlExists(url)
+    return not Page.urlExists(url)
+
+
+@addon
+def check_pages_needed(archive, urls):
+    """Returns a list of true/false for each URL: true if the page hasn't been fetched"""
+    existing = Page.urlsExisting(urls)
+    return [str(url) not in existing for url in urls]
 
 
 @addon
@@ -144,12 +163,10 @@ def add_fetched_page(archive, id, url, page):
     if redirectUrl:
         # Removes the YouTube start time we add
         redirectUrl = redirectUrl.replace("&start=86400", "")
-    if page.get("activityId"):
-        page["activityId"] = Activity.getID(page["activityId"], default=None)
     Page.replaceUuid(
         id,
         url=url,
-        activityId=page.get("activityId"),
+        activityID=Activity.getID(page.get("activityId"), default=None),
         timeToFetch=page["timeToFetch"],
         redirectUrl=redirectUrl,
         scrapeData=page,
@@ -163,17 +180,18 @@ def substitute_location(path):
 
 @addon
 def set_active_archive(archive, archiveLocation):
-    global withheld_log_messages
+    global withheld_log_records
     archiveLocation = substitute_location(archiveLocation)
     global active_archive
     if active_archive:
         active_archive.close()
     active_archive = Archive(archiveLocation)
-    if withheld_log_messages:
-        filename = os.path.join(active_archive.path, "addon.log")
-        with open(filename, "a") as fp:
-            fp.write("\n".join(withheld_log_messages))
-        withheld_log_messages = []
+    metrics.attach(os.path.join(active_archive.path, "metrics.json"))
+    if withheld_log_records:
+        writer = get_log_writer(os.path.join(active_archive.path, "addon.log"), level=DEFAULT_LEVEL)
+        for record in withheld_log_records:
+            writer.put_record(record)
+        withheld_log_records = []
     return archiveLocation
 
 set_active_archive.archive_optional = True
@@ -203,54 +221,89 @@ def list_archives(archive):
     return connlist.list_archives()
 
 list_archives.archive_optional = True
+list_archives.concurrent = True
+
+withheld_log_records = []
+
+@addon
+def get_metrics(archive):
+    return metrics.as_json()
+
+get_metrics.archive_optional = True
+get_metrics.concurrent = True
+
+
+@addon
+def batch(archive, calls):
+    """Runs a list of calls (`{"name", "args", "kwargs"}`) in one transaction
+
+    Returns a list with `{"result": ...}` or `{"error": ..., "traceback": ...}` for each call. Each
+    call has its own savepoint, so one that fails is undone without stopping the others.
+    """
+    return sqlhub.doInTransaction(run_batch, calls)
+
+
+def run_batch(calls):
+    trans = sqlhub.getConnection()
+    # An outer savepoint makes sure the inner ones are all in one transaction:
+    trans.query("SAVEPOINT batch")
+    results = []
+    for call in calls:
+        handler = message_handlers.get(call.get("name"))
+        try:
+            if not handler or handler is batch:
+                raise Exception("Can't call %r in a batch" % call.get("name"))
+            trans.query("SAVEPOINT batch_call")
+            try:
+                result = call_handler(handler, call)
+            except Exception:
+                trans.query("ROLLBACK TO batch_call")
+                trans.query("RELEASE batch_call")
+                # Objects cached from the undone changes need to be reloaded:
+                for sub_cache in trans.cache.allSubCaches():
+                    for id in list(sub_cache.allIDs()):
+                        instance = sub_cache.tryGet(id)
+                        if instance is not None:
+                            instance.expire()
+                raise
+            trans.query("RELEASE batch_call")
+            results.append({"result": result})
+        except Exception as e:
+            tb = traceback.format_exc()
+            log(active_archive, "Error processing batched call %s: %s" % (describe_message(call), e), tb, level='s_err')
+            results.append({"error": str(e), "traceback": tb})
+    trans.query("RELEASE batch")
+    return results
 
-withheld_log_messages = []
 
 @addon
 def log(archive, *args, level='log', stack=None):
-    lines = []
-    if stack:
-        log_location = stack.splitlines()[0]
-        log_location = re.sub(r'moz-extension://[a-f0-9-]+/', '/', log_location)
-    else:
-        log_location = ""
-    lines.append("Log/{: <5} {} {}".format(level, int(time.time() * 1000), log_location))
-    if len(str(args)) < 70 and len(args) > 1:
-        args = (args,)
-    for arg in args:
-        if isinstance(arg, str):
-            s = arg
-        else:
-            s = pprint.pformat(arg, compact=True)
-            if isinstance(arg, tuple):
-                s = s[1:-1]
-        s = s.splitlines()
-        for line in s:
-            lines.append("    %s" % line)
-    if not args:
-        lines.append("    (no arguments)")
-    text = "\n".join(lines) + "\n"
     if not archive:
-        filename = os.path.join(sys.prefix, "../addon.log")
-        withheld_log_messages.append(text)
+        writer = get_log_writer(os.path.join(sys.prefix, "../addon.log"), level=DEFAULT_LEVEL)
     else:
-        filename = os.path.join(archive.path, "addon.log")
-    with open(filename, "a") as fp:
-        fp.write(text)
+        writer = get_log_writer(os.path.join(archive.path, "addon.log"), level=DEFAULT_LEVEL)
+    if not writer.enabled(level):
+        return
+    record = (time.time(), level, stack, args)
+    if not archive:
+        # These will also be written to the archive's log once it is set
+        withheld_log_records.append(record)
+    writer.put_record(record)
 
 log.archive_optional = True
+log.concurrent = True
 
 class LogPrinter:
 
     def __init__(self):
-        self._cache = ""
+        self._cache = []
 
     def write(self, s):
         sys.stderr.write(s)
-        self._cache += s
-        if self._cache.endswith("\n") or len(self._cache.splitlines()) > 1:
-            log(active_archive, "print: %s" % self._cache.rstrip())
-            self._cache = ""
+        self._cache.append(s)
+        if "\n" in s:
+            log(active_archive, "print: %s" % "".join(self._cache).rstrip())
+            self._cache = []
 
     def flush(self):
         sys.stderr.flush()
@@ -263,51 +316,81 @@ def write_page(archive, url, data):
     pages[0].scrapeData = data
 
 
-def connect():
+def connect(workers=4):
+    global recorder
+    recorder = recording.recorder_from_environment("BROWSINGLAB_RECORD_MESSAGES")
     print("Running browsing-connector from %s" % __file__, file=sys.stderr)
     sys.stdout = LogPrinter()
-    while True:
-        m_name = "(unknown)"
-        try:
-            message = get_message()
-            m_name = "%(name)s(%(args)s%(kwargs)s)" % dict(
-                name=message["name"],
-                args=", ".join(json.dumps(s) for s in message.get("args", [])),
-                kwargs=", ".join("%s=%s" % (name, json.dumps(value)) for name, value in message.get("kwargs", {}).items()),
-            )
-            if len(m_name) > 100:
-                m_name = m_name[:60] + " ... " + m_name[-10:]
-            # print("Message:", m_name, file=sys.stderr)
-            handler = message_handlers.get(message["name"])
-            if not handler:
-                print("Error: got unexpected message name: %r" % message["name"], file=sys.stderr)
-                continue
-            if active_archive is None and not getattr(handler, "archive_optional", False):
-                raise Exception("Attempted to send message before setting archive: %s()" % m_name)
-            result = handler(active_archive, *message.get("args", ()), **message.get("kwargs", {}))
-            send_message({"id": message["id"], "result": result})
-        except Exception as e:
-            tb = traceback.format_exc()
-            log(active_archive, "Error processing message %s(): %s" % (m_name, e), tb, level='s_err')
-            send_message({"id": message["id"], "error": str(e), "traceback": tb})
+    dispatcher = Dispatcher(handle_message, is_concurrent, workers=workers)
+    dispatcher.run(get_message, send_message)
+    metrics.save()
+
+
+def is_concurrent(message):
+    return getattr(message_handlers.get(message.get("name")), "concurrent", False)
+
+
+def handle_message(message):
+    """Runs the handler for the message, returning the reply (or None if there's no reply)"""
+    try:
+        if log_messages:
+            print("Message:", describe_message(message), file=sys.stderr)
+        handler = message_handlers.get(message["name"])
+        if not handler:
+            print("Error: got unexpected message name: %r" % message["name"], file=sys.stderr)
+            return None
+        result = call_handler(handler, message)
+        return {"id": message["id"], "result": result}
+    except Exception as e:
+        tb = traceback.format_exc()
+        log(active_archive, "Error processing message %s: %s" % (describe_message(message), e), tb, level='s_err')
+        return {"id": message.get("id"), "error": str(e), "traceback": tb}
+
+
+def call_handler(handler, message):
+    """Calls the handler with the message's arguments, and records its metrics"""
+    if active_archive is None and not getattr(handler, "archive_optional", False):
+        raise Exception("Attempted to send message before setting archive: %s" % describe_message(message))
+    start = time.perf_counter()
+    error = True
+    try:
+        result = handler(active_archive, *message.get("args", ()), **message.get("kwargs", {}))
+        error = False
+    finally:
+        metrics.record(message["name"], time.perf_counter() - start, error=error)
+    return result
+
+
+# Made by get_message() the first time it's called:
+frame_reader = None
 
 
 def get_message():
-    length = sys.stdin.buffer.read(4)
-    if len(length) == 0:
-        sys.exit(0)
-    length = struct.unpack('@I', length)[0]
-    message = sys.stdin.buffer.read(length).decode('utf-8')
-    message = json.loads(message)
+    """Reads one message from stdin, returning None when stdin is closed"""
+    global frame_reader
+    if frame_reader is None:
+        frame_reader = frames.FrameReader(sys.stdin.buffer)
+    content = frame_reader.read_frame()
+    if content is None:
+        return None
+    size = len(content)
+    if recorder:
+        recorder.record(recording.INCOMING, frames.length_struct.pack(size), content)
+    message = frames.loads_view(content)
+    metrics.message_received(message, size)
     return message
 
 
 def encode_message(message):
-    content = json.dumps(message).encode('utf-8')
-    length = struct.pack('@I', len(content))
-    return length + content
+    return frames.encode_frame(message)
 
 
 def send_message(message):
-    sys.__stdout__.buffer.write(encode_message(message))
+    content = frames.dumps(message)
+    header = frames.length_struct.pack(len(content))
+    if recorder:
+        recorder.record(recording.OUTGOING, header, content)
+    metrics.reply_sent(message, len(content))
+    sys.__stdout__.buffer.write(header)
+    sys.__stdout__.buffer.write(content)
     sys.__stdout__.buffer.flush()
@@ -112,7 +112,20 @@ class Page(SQLObject, Mixin):
 
     @classmethod
     def urlExists(cls, url):
-        return bool(list(cls.selectBy(url=url)))
+        return bool(cls.urlsExisting([url]))
+
+    @classmethod
+    def urlsExisting(cls, urls, chunk_size=500):
+        """Returns the set of `urls` (as strings) that have a page, with a few indexed queries"""
+        conn = cls._connection
+        urls = list(set(str(url) for url in urls))
+        existing = set()
+        for i in range(0, len(urls), chunk_size):
+            chunk = urls[i:i + chunk_size]
+            rows = conn.queryAll("SELECT url FROM %s WHERE url IN (%s)" % (
+                cls.sqlmeta.table, ", ".join(conn.sqlrepr(url) for url in chunk)))
+            existing.update(row[0] for row in rows)
+        return existing
 
 
 class Activity(SQLObject, Mixin):
@@ -169,3 +182,5 @@ def create_tables():
     classes = [Browser, BrowserSession, Activity, Page, ActivityLink]
     for cls in classes:
         cls.createTable(ifNotExists=True)
+    # Page.urlsExisting() looks pages up by URL:
+    sqlhub.processConnection.query("CREATE INDEX IF NOT EXISTS page_url ON page (url)")
@@ -97,6 +97,10 @@ this.communication = (function() {
     return portCall("check_page_needed", [url]);
   };
 
+  exports.check_pages_needed = function(urls) {
+    return portCall("check_pages_needed", [urls]);
+  };
+
   // FIXME: should be (url, pageData) but needs updating in saver.py
   exports.add_fetched_page = function(id, url, page) {
     return portCall("add_fetched_page", [id, url, page]);
@@ -2,6 +2,8 @@
 
 python3 -m venv .venv
 ./.venv/bin/pip install --upgrade pip
+# browsinglab uses modules from the pha library:
+./.venv/bin/pip install -e ./python
 ./.venv/bin/pip install -e .
 ./.venv/bin/pip install -r ./dev-requirements.txt
 if [[ ! -e blab ]] ; then
@@ -0,0 +1,66 @@
+"""
+Measures how long it takes to import the saver, and checks it doesn't import heavy libraries
+
+The saver (`pha.saver.run_saver`) is started by Firefox for every native connection, and only
+needs sqlite and json. This runs `python -X importtime` in a fresh interpreter, prints the
+slowest imports, and exits with an error if any of `HEAVY_MODULES` were imported or the total
+time is over `--max-ms`, so it can be used as a regression check.
+
+Use: `python benchmarks/bench_import_time.py [--module pha.saver] [--max-ms 150] [--runs 5]`
+"""
+import os
+import re
+import sys
+import argparse
+import subprocess
+
+HEAVY_MODULES = ["feedparser", "nltk", "lxml", "sumy", "cgi", "IPython", "numpy"]
+
+importtime_regex = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$')
+
+
+def import_times(module):
+    """Returns `{module_name: (self_us, cumulative_us)}` for one fresh import of `module`"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.abspath(os.path.join(__file__, "../.."))] + [p for p in [env.get("PYTHONPATH")] if p])
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import %s" % module],
+        stderr=subprocess.PIPE, env=env, check=True)
+    times = {}
+    for line in proc.stderr.decode("UTF-8").splitlines():
+        match = importtime_regex.search(line)
+        if match:
+            times[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="pha.saver", help="Module to import")
+    parser.add_argument("--max-ms", type=float, default=150, help="Fail if the import takes longer than this")
+    parser.add_argument("--runs", type=int, default=5, help="Use the best of this many runs")
+    args = parser.parse_args()
+    runs = [import_times(args.module) for i in range(args.runs)]
+    best = min(runs, key=lambda times: times[args.module][1])
+    total_ms = best[args.module][1] / 1000
+    print("import %s: %.1fms (best of %i)" % (args.module, total_ms, args.runs))
+    print()
+    print("Slowest modules (self time):")
+    for name, (self_us, cumulative_us) in sorted(best.items(), key=lambda item: -item[1][0])[:15]:
+        print("  %-40s %8.1fms %8.1fms" % (name, self_us / 1000, cumulative_us / 1000))
+    failed = False
+    heavy = sorted(name for name in best if name.split(".")[0] in HEAVY_MODULES)
+    if heavy:
+        print()
+        print("Error: heavy modules imported:", ", ".join(heavy))
+        failed = True
+    if total_ms > args.max_ms:
+        print()
+        print("Error: import took %.1fms, more than %.1fms" % (total_ms, args.max_ms))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Benchmarks the common archive queries before and after the index migration
+
+Creates a synthetic archive (500k activities by default) in a temporary directory with only the
+base schema, times the lookups the library and saver do, applies the remaining migrations, and
+times them again.
+
+Use: `python benchmarks/bench_indexes.py [number_of_activities]`
+"""
+import os
+import sys
+import shutil
+import time
+import random
+import sqlite3
+import tempfile
+import uuid
+from pha import Archive, migrations
+
+DOMAINS = ["example%i.com" % i for i in range(2000)]
+
+
+def create_activity(conn, count):
+    c = conn.cursor()
+    c.execute("INSERT INTO browser (id, userAgent) VALUES ('bench', 'benchmark')")
+    ids = []
+    rows = []
+    pages = []
+    links = []
+    load_time = 1500000000000
+    for i in range(count):
+        activity_id = str(uuid.uuid4())
+        url = "https://%s/article/%i" % (random.choice(DOMAINS), random.randint(0, count // 4))
+        load_time += random.randint(1, 60000)
+        source_id = random.choice(ids) if ids and random.random() < 0.5 else None
+        rows.append((activity_id, "bench", url, "visit-%i" % i, load_time, source_id))
+        ids.append(activity_id)
+        if random.random() < 0.3:
+            pages.append((str(uuid.uuid4()), url))
+        for j in range(random.randint(0, 3)):
+            links.append((activity_id, "https://%s/article/%i" % (random.choice(DOMAINS), j), "link"))
+    c.executemany("""
+        INSERT INTO activity (id, browserId, url, browserVisitId, loadTime, sourceId)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, rows)
+    c.executemany("INSERT INTO page (id, url) VALUES (?, ?)", pages)
+    c.executemany("INSERT INTO activity_link (activity_id, url, text) VALUES (?, ?, ?)", links)
+    conn.commit()
+    return rows
+
+
+def queries(sample):
+    activity_id, _, url, visit_id, _, _ = sample
+    return [
+        ("get_activity(url)", """
+            %s
+            LEFT JOIN page ON page.url = activity.url
+            WHERE browser.id = activity.browserId
+              AND activity.url = ?
+        """ % Archive.base_activity_sql, (url,)),
+        ("get_activity_by_source(id)", """
+            %s
+            LEFT JOIN page ON page.url = activity.url
+            WHERE browser.id = activity.browserId
+              AND activity.sourceId = ?
+            ORDER BY activity.loadTime DESC
+        """ % Archive.base_activity_sql, (activity_id,)),
+        ("iter_activity(limit=100)", """
+            %s
+            LEFT JOIN page ON page.url = activity.url
+            WHERE browser.id = activity.browserId
+            ORDER BY activity.loadTime DESC, activity.id DESC
+            LIMIT 100
+        """ % Archive.base_activity_sql, ()),
+        ("activity by browserVisitId", """
+            SELECT id FROM activity WHERE browserVisitId = ?
+        """, (visit_id,)),
+        ("page by url", """
+            SELECT COUNT(*) FROM page WHERE url = ?
+        """, (url,)),
+        ("activity_link by activity", """
+            SELECT url, text FROM activity_link WHERE activity_id = ?
+        """, (activity_id,)),
+    ]
+
+
+def time_queries(conn, samples):
+    c = conn.cursor()
+    results = {}
+    for sample in samples:
+        for name, sql, args in queries(sample):
+            start = time.perf_counter()
+            c.execute(sql, args)
+            c.fetchall()
+            results[name] = results.get(name, 0) + time.perf_counter() - start
+    return {name: total / len(samples) for name, total in results.items()}
+
+
+def main(count):
+    path = tempfile.mkdtemp(prefix="pha-bench-")
+    conn = sqlite3.connect(os.path.join(path, "history.sqlite"))
+    migrations.migrate(conn, target=1)
+    print("Creating %i activities in %s" % (count, path))
+    rows = create_activity(conn, count)
+    samples = random.sample(rows, 20)
+    before = time_queries(conn, samples)
+    start = time.perf_counter()
+    migrations.migrate(conn)
+    print("Migrated in %.1fs" % (time.perf_counter() - start))
+    after = time_queries(conn, samples)
+    print()
+    print("%-30s %12s %12s %10s" % ("query", "no index", "indexed", "speedup"))
+    for name in before:
+        print("%-30s %10.2fms %10.2fms %9.0fx" % (
+            name, before[name] * 1000, after[name] * 1000, before[name] / max(after[name], 1e-9)))
+    conn.close()
+    shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if sys.argv[1:] else 500000)
@@ -0,0 +1,114 @@
+"""
+Compares ways of decoding large native messages: peak memory and time
+
+Builds an `add_fetched_page` message with a page of each size, frames it like the browser does, and
+decodes it from an in-memory stream with:
+
+* `read+decode`: the old `get_message()`: read the bytes, decode to a str, `json.loads()`
+* `FrameReader/json`: `pha.frames.FrameReader`, with the json module
+* `FrameReader/orjson`: the same, with orjson (if it's installed)
+
+Peak memory is measured with tracemalloc, relative to the size of the frame. The FrameReader keeps
+its buffer between messages (up to `frames.MAX_RETAINED_BUFFER`), so for small frames the buffer
+isn't part of the peak.
+
+Use: `python benchmarks/bench_message_decode.py [size_in_mb ...]`
+"""
+import io
+import sys
+import json
+import time
+import struct
+import random
+import tracemalloc
+from pha import frames
+
+REPEAT = 5
+
+
+def make_frame(size):
+    words = ["word%i" % i for i in range(5000)]
+    paragraphs = []
+    length = 0
+    while length < size:
+        paragraph = "<p>%s</p>" % " ".join(random.choice(words) for i in range(100))
+        paragraphs.append(paragraph)
+        length += len(paragraph)
+    message = {
+        "id": 1,
+        "name": "add_fetched_page",
+        "args": [],
+        "kwargs": {
+            "id": "page-id",
+            "url": "https://example.com/",
+            "page": {
+                "url": "https://example.com/",
+                "timeToFetch": 1000,
+                "body": "<body>%s</body>" % "".join(paragraphs),
+                "links": [{"url": "https://example.com/%i" % i, "text": random.choice(words)} for i in range(1000)],
+            },
+        },
+    }
+    content = json.dumps(message).encode("utf-8")
+    return struct.pack("@I", len(content)) + content
+
+
+def read_and_decode(fp):
+    length = struct.unpack("@I", fp.read(4))[0]
+    return json.loads(fp.read(length).decode("utf-8"))
+
+
+# Like the saver, keeps one FrameReader (and its buffer) for every message:
+reader = frames.FrameReader(None)
+
+
+def frame_reader(fp):
+    reader.fp = fp
+    return reader.read_message()
+
+
+def methods():
+    result = [
+        ("read+decode", read_and_decode, None),
+        ("FrameReader/json", frame_reader, None),
+    ]
+    if frames.orjson is not None:
+        result.append(("FrameReader/orjson", frame_reader, frames.orjson))
+    return result
+
+
+def measure(method, backend, frame):
+    saved = frames.orjson
+    frames.orjson = backend
+    try:
+        times = []
+        for i in range(REPEAT):
+            fp = io.BytesIO(frame)
+            start = time.perf_counter()
+            method(fp)
+            times.append(time.perf_counter() - start)
+        fp = io.BytesIO(frame)
+        tracemalloc.start()
+        message = method(fp)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del message
+    finally:
+        frames.orjson = saved
+    return min(times), peak
+
+
+def main(sizes):
+    print("%-8s %-20s %10s %12s %8s" % ("size", "method", "time", "peak memory", "x frame"))
+    for size in sizes:
+        frame = make_frame(int(size * 1000000))
+        for name, method, backend in methods():
+            elapsed, peak = measure(method, backend, frame)
+            print("%-8s %-20s %8.1fms %10.1fMB %7.1fx" % (
+                "%gMB" % size, name, elapsed * 1000, peak / 1000000, peak / len(frame)))
+        if frames.orjson is None:
+            print("(orjson isn't installed)")
+
+
+if __name__ == "__main__":
+    main([float(arg) for arg in sys.argv[1:]] or [1, 10, 30])
@@ -0,0 +1,301 @@
+"""
+Replays a stream of native messages into the saver (or the browsinglab connector) through a pipe
+
+The stream is either a recording (see `pha.recording`; record with `$PHA_RECORD_MESSAGES`) or a
+synthetic session: a browser registration, then batches of history and activity, page checks,
+fetched pages of varying size, and the occasional status and log message. The connector only gets
+the messages it can store (its schema has no browser history).
+
+The stream is run twice, each time in a new process with an empty archive:
+
+* throughput: everything is written as fast as the process reads it, like a busy browser, and the
+  total messages/sec is reported.
+* latency: one message at a time, waiting for each reply. This reports the p50/p99 time from sending
+  a message to getting its reply, and the peak RSS of the process while each kind of message was
+  being handled (sampled from `/proc/<pid>/status`, so Linux only).
+
+Use: `python benchmarks/bench_replay.py [--recording FILE | --synthetic N] [--target saver|connector]`
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import struct
+import argparse
+import tempfile
+import threading
+import subprocess
+
+from pha.saver import encode_message, ACTIVITY_COLUMNS
+from pha.recording import read_frames, INCOMING
+
+PYTHON_DIR = os.path.abspath(os.path.join(__file__, "../.."))
+ROOT_DIR = os.path.abspath(os.path.join(PYTHON_DIR, ".."))
+
+TARGETS = {
+    "saver": (PYTHON_DIR, "from pha.saver import run_saver; run_saver(sys.argv[1])"),
+    "connector": (ROOT_DIR, "from browsinglab.connector import connect; connect()"),
+}
+
+DOMAINS = ["example%i.com" % i for i in range(200)]
+
+# Keys the browsinglab connector spells differently from the saver:
+CONNECTOR_KEYS = {
+    "client_redirect": "clientRedirect",
+    "server_redirect": "serverRedirect",
+    "forward_back": "forwardBack",
+    "from_address_bar": "fromAddressBar",
+}
+
+
+def random_url():
+    return "https://%s/article/%i" % (random.choice(DOMAINS), random.randint(0, 100000))
+
+
+def synthetic_messages(count, *, target="saver", archive_path=None, seed=0):
+    """Returns a list of `count` (or a few more) messages like a browsing session would send"""
+    random.seed(seed)
+    browser_id = str(uuid.UUID(int=random.getrandbits(128)))
+    session_id = str(uuid.UUID(int=random.getrandbits(128)))
+    messages = []
+    if target == "connector":
+        messages.append(("set_active_archive", [archive_path], {}))
+    messages.append(("register_browser", [], {"browserId": browser_id, "userAgent": "bench_replay"}))
+    messages.append(("register_session", [session_id, browser_id, 0], {}))
+    load_time = 1500000000000
+    urls = []
+    while len(messages) < count:
+        kind = random.random()
+        if kind < 0.1 and target == "saver":
+            history_items = {}
+            for i in range(50):
+                url = random_url()
+                urls.append(url)
+                visits = {}
+                for j in range(random.randint(1, 3)):
+                    load_time += random.randint(1, 60000)
+                    visits[str(uuid.UUID(int=random.getrandbits(128)))] = {
+                        "visitTime": load_time,
+                        "transition": "link",
+                        "referringVisitId": None,
+                    }
+                history_items[str(uuid.UUID(int=random.getrandbits(128)))] = {
+                    "url": url, "title": "Page %s" % url, "visits": visits}
+            messages.append(("add_history_list", [], {
+                "browserId": browser_id, "sessionId": session_id, "historyItems": history_items}))
+        elif kind < 0.3:
+            activities = [synthetic_activity(session_id, load_time + i, target) for i in range(20)]
+            urls.extend(activity["url"] for activity in activities)
+            kwargs = {"browserId": browser_id, "activityItems": activities}
+            if target == "connector":
+                kwargs["sessionId"] = session_id
+            messages.append(("add_activity_list", [], kwargs))
+        elif kind < 0.55 and urls:
+            messages.append(("check_page_needed", [random.choice(urls)], {}))
+        elif kind < 0.85 and urls:
+            url = random.choice(urls)
+            messages.append(("add_fetched_page", [], {
+                "id": str(uuid.UUID(int=random.getrandbits(128))),
+                "url": url,
+                "page": synthetic_page(url),
+            }))
+        elif kind < 0.9 and target == "saver":
+            messages.append(("status", [], {"browserId": browser_id}))
+        elif kind < 0.95 and target == "saver":
+            messages.append(("get_needed_pages", [], {}))
+        else:
+            messages.append(("log", ["Replayed log message", {"count": len(messages)}], {"level": "log"}))
+    return [
+        {"id": i, "name": name, "args": args, "kwargs": kwargs}
+        for i, (name, args, kwargs) in enumerate(messages)]
+
+
+def synthetic_activity(session_id, load_time, target):
+    activity = dict.fromkeys(ACTIVITY_COLUMNS)
+    activity.pop("browserId")
+    activity.update({
+        "id": str(uuid.UUID(int=random.getrandbits(128))),
+        "sessionId": session_id,
+        "url": random_url(),
+        "title": "Activity",
+        "loadTime": load_time,
+        "unloadTime": load_time + random.randint(1000, 600000),
+        "transitionType": "link",
+        "client_redirect": False,
+        "server_redirect": False,
+        "forward_back": False,
+        "from_address_bar": False,
+        "copyEvents": [],
+        "allFeeds": [],
+        "linkInformation": [
+            {"url": random_url(), "text": "link %i" % i} for i in range(random.randint(0, 30))],
+    })
+    if target == "connector":
+        for key, connector_key in CONNECTOR_KEYS.items():
+            activity[connector_key] = activity.pop(key)
+    return activity
+
+
+def synthetic_page(url):
+    paragraphs = "".join(
+        "<p>%s</p>" % " ".join("word%i" % random.randint(0, 5000) for i in range(80))
+        for i in range(random.randint(5, 300)))
+    return {
+        "url": url,
+        "title": "Page",
+        "timeToFetch": random.randint(100, 5000),
+        "body": "<body>%s</body>" % paragraphs,
+        "passwordFields": [],
+        "openGraph": {},
+    }
+
+
+def recorded_messages(filename, archive_path):
+    messages = []
+    for direction, created, frame in read_frames(filename, INCOMING):
+        message = json.loads(frame[4:].decode("UTF-8"))
+        if message.get("name") == "set_active_archive":
+            # Never replay into the archive that was recorded:
+            message["args"] = [archive_path]
+            message.pop("kwargs", None)
+        messages.append(message)
+    return messages
+
+
+def read_replies(stdout):
+    while True:
+        length = stdout.read(4)
+        if len(length) < 4:
+            return
+        yield json.loads(stdout.read(struct.unpack("@I", length)[0]).decode("UTF-8"))
+
+
+def start_process(target, archive_path):
+    cwd, code = TARGETS[target]
+    env = dict(os.environ)
+    env.pop("PHA_RECORD_MESSAGES", None)
+    env.pop("BROWSINGLAB_RECORD_MESSAGES", None)
+    # The connector imports pha, which may not be installed:
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [PYTHON_DIR, env.get("PYTHONPATH")]))
+    return subprocess.Popen(
+        [sys.executable, "-c", "import sys; " + code, archive_path],
+        cwd=cwd, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+
+def rss_kb(pid):
+    try:
+        with open("/proc/%i/status" % pid) as fp:
+            for line in fp:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except (FileNotFoundError, ProcessLookupError):
+        pass
+    return 0
+
+
+def run_throughput(target, messages, archive_path):
+    frames = [encode_message(message) for message in messages]
+    expected = sum(1 for message in messages if message.get("id") is not None)
+    proc = start_process(target, archive_path)
+
+    def write():
+        for frame in frames:
+            proc.stdin.write(frame)
+        proc.stdin.close()
+
+    start = time.perf_counter()
+    writer = threading.Thread(target=write)
+    writer.start()
+    errors = 0
+    replies = 0
+    for reply in read_replies(proc.stdout):
+        replies += 1
+        errors += "error" in reply
+        if replies == expected:
+            break
+    elapsed = time.perf_counter() - start
+    writer.join()
+    proc.wait()
+    return {"messages": len(messages), "replies": replies, "errors": errors, "seconds": elapsed}
+
+
+def run_latency(target, messages, archive_path):
+    proc = start_process(target, archive_path)
+    replies = read_replies(proc.stdout)
+    current = [None]
+    peaks = {}
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            name = current[0]
+            if name:
+                peaks[name] = max(peaks.get(name, 0), rss_kb(proc.pid))
+            time.sleep(0.001)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    latencies = {}
+    for message in messages:
+        current[0] = message["name"]
+        start = time.perf_counter()
+        proc.stdin.write(encode_message(message))
+        proc.stdin.flush()
+        next(replies)
+        latencies.setdefault(message["name"], []).append(time.perf_counter() - start)
+        current[0] = None
+    done.set()
+    proc.stdin.close()
+    proc.wait()
+    return latencies, peaks
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--recording", help="Replay the incoming messages of this recording")
+    source.add_argument("--synthetic", type=int, default=2000, help="Number of synthetic messages to replay")
+    parser.add_argument("--target", choices=sorted(TARGETS), default="saver")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    path = tempfile.mkdtemp(prefix="pha-replay-")
+    try:
+        results = {}
+        for mode in "throughput", "latency":
+            archive_path = os.path.join(path, mode)
+            os.makedirs(archive_path)
+            if args.recording:
+                messages = recorded_messages(args.recording, archive_path)
+            else:
+                messages = synthetic_messages(
+                    args.synthetic, target=args.target, archive_path=archive_path, seed=args.seed)
+            if mode == "throughput":
+                results[mode] = run_throughput(args.target, messages, archive_path)
+            else:
+                results[mode] = run_latency(args.target, messages, archive_path)
+        throughput = results["throughput"]
+        print("%s: %i messages in %.2fs, %.0f messages/sec (%i errors)" % (
+            args.target, throughput["messages"], throughput["seconds"],
+            throughput["messages"] / throughput["seconds"], throughput["errors"]))
+        latencies, peaks = results["latency"]
+        print()
+        print("%-22s %7s %10s %10s %12s" % ("handler", "count", "p50", "p99", "peak RSS"))
+        for name in sorted(latencies, key=lambda name: -sum(latencies[name])):
+            times = latencies[name]
+            print("%-22s %7i %8.2fms %8.2fms %10.1fMB" % (
+                name, len(times), percentile(times, 0.5) * 1000, percentile(times, 0.99) * 1000,
+                peaks.get(name, 0) / 1024))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,20 +3,28 @@ import sqlite3
 import json
 import hashlib
 import re
-from cgi import escape as html_escape
+import zlib
+import pickle
+import threading
+from html import escape as _html_escape
 from urllib.parse import quote as url_quote
 from urllib.parse import urlparse, parse_qs
-import feedparser
 from collections import defaultdict
 from collections.abc import Mapping
+from . import pagestore
+from . import migrations
+from . import changes
+from . import pagemap
+from . import activityframe
+from .bloom import BloomFilter
+from .connection import ArchiveConnection
 lxml = None
+# feedparser is slow to import, and only needed for Feed.parsed:
+feedparser = None
 
 www_regex = re.compile(r"^www[0-9]*\.")
 markup_regex = re.compile(r"<.*?>", re.S)
 
-with open(os.path.abspath(os.path.join(__file__, "../schema.sql"))) as fp:
-    schema_sql = fp.read()
-
 STANDARD_SCRIPT = '''\
 <script>
 window.addEventListener("load", function () {
@@ -40,6 +48,11 @@ window.addEventListener("load", function () {
 </script>'''
 
 
+def html_escape(s, quote=False):
+    # Like the old cgi.escape(), only escapes quotes when asked
+    return _html_escape(s, quote=quote)
+
+
 def domain(url):
     d = urlparse(url).hostname
     match = www_regex.search(d)
@@ -68,22 +81,98 @@ class URLMixin:
 
 
 class Archive:
-    def __init__(self, path):
+    """An archive directory: `history.sqlite` plus the fetched pages
+
+    The database is in WAL mode, so readers don't block the writer or each other. `conn` is the one
+    connection that writes; `read_conn` is a read-only connection for the current thread, which the
+    query methods here use, so several threads (or processes) can analyze an archive while the saver
+    is adding to it. A reader sees what was committed when its query started.
+
+    With `readonly=True` nothing is written (not even migrations, so the archive must already be
+    up to date), and `conn` is read-only too.
+    """
+
+    # How much of the database file sqlite may memory-map, per connection:
+    mmap_size = 1 << 28
+    # How long (in seconds) a connection waits for a lock before giving up:
+    busy_timeout = 30
+
+    def __init__(self, path, *, readonly=False):
         if not os.path.exists(path):
             raise Exception("Could not find path %s" % path)
         self.path = path
+        self.readonly = readonly
         self.sqlite_path = os.path.join(path, 'history.sqlite')
-        self.conn = sqlite3.connect(self.sqlite_path)
-        self.conn.row_factory = sqlite3.Row
-        c = self.conn.cursor()
-        c.executescript(schema_sql)
-        c.close()
-        self.conn.commit()
+        self._local = threading.local()
+        self._read_conns = []
+        self._read_conns_lock = threading.Lock()
+        if readonly:
+            self.conn = self._connect_readonly()
+            version = self.conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0]
+            if version != len(migrations.MIGRATIONS):
+                raise Exception("Archive %s needs migrating; open it without readonly first" % path)
+        else:
+            # The saver uses the connection from several threads, holding self.lock:
+            self.conn = sqlite3.connect(
+                self.sqlite_path, timeout=self.busy_timeout, check_same_thread=False, factory=ArchiveConnection)
+            self.conn.row_factory = sqlite3.Row
+            # WAL is kept in the file, so this only changes anything the first time. With WAL, NORMAL
+            # doesn't sync on every commit: after a power loss the last commits may be gone, but the
+            # database is never corrupt, and page data is synced before its row is committed.
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            self.conn.execute("PRAGMA synchronous = NORMAL")
+            self.conn.execute("PRAGMA mmap_size = %i" % self.mmap_size)
+            migrations.migrate(self.conn)
+        self.lock = threading.RLock()
         self.pages_path = os.path.join(path, 'pages')
-        if not os.path.exists(self.pages_path):
+        if not readonly and not os.path.exists(self.pages_path):
             os.makedirs(self.pages_path)
+        self.packs_path = os.path.join(path, 'packs')
+        self.page_layout, self.page_layout_migrating = pagestore.read_layout(self)
+        self._page_files = None
+        # The URLs of page_files in each layout, and whether any of their names were truncated:
+        self._page_file_urls = None
+        self._truncated_page_files = False
+        self._packed_urls = None
+        self._fetched_url_filter = None
+        self._url_filter_added = None
+        self._url_filter_lock = threading.Lock()
+        self._page_dictionaries = {}
+        self._pack_maps = {}
+        # The saver sets this to a pagewriter.PageWriter, to write pages in the background:
+        self.page_writer = None
         self.update_status()
 
+    def _connect_readonly(self):
+        uri = "file:%s?mode=ro" % url_quote(os.path.abspath(self.sqlite_path))
+        conn = sqlite3.connect(
+            uri, uri=True, timeout=self.busy_timeout, check_same_thread=False, factory=ArchiveConnection)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA mmap_size = %i" % self.mmap_size)
+        return conn
+
+    @property
+    def read_conn(self):
+        """A read-only connection for this thread (each thread gets its own, opened when first used)
+
+        It doesn't see changes on `conn` until they are committed.
+        """
+        conn = getattr(self._local, "read_conn", None)
+        if conn is None:
+            conn = self._local.read_conn = self._connect_readonly()
+            with self._read_conns_lock:
+                self._read_conns.append(conn)
+        return conn
+
+    def close(self):
+        """Closes the writer and every thread's read-only connection"""
+        with self._read_conns_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns = []
+        self._local = threading.local()
+        self.conn.close()
+
     def __repr__(self):
         return '<Archive at %r %i activities, %i/%i URLs fetched, %i errored>' % (self.path, self.activity_count, self.fetched_count, self.activity_url_count, self.error_count)
 
@@ -137,46 +226,251 @@ class Archive:
         FROM activity, browser
     """
 
-    def update_status(self):
+    # Number of rows fetched at a time when streaming activity:
+    activity_batch_size = 1000
+
+    # Number of values bound in one `IN (...)` query:
+    sql_chunk_size = 500
+
+    def update_status(self, recount=False):
+        """Updates the activity_count, activity_url_count, fetched_count, and error_count attributes
+
+        These come from counters kept up to date by the code that writes to the archive (see
+        `pha.changes`). If `recount` is true then the counters are first recomputed from scratch,
+        which is slow on a large archive, and saved `ActivityPool` snapshots are marked out of date:
+        do this after changing activity or pages some other way.
+        """
         c = self.conn.cursor()
+        if recount:
+            migrations.recount_stats(c)
+            changes.forget_changes(c)
+            self.conn.commit()
         c.execute("""
-            SELECT
-                (SELECT COUNT(*) FROM activity) AS activity_count,
-                (SELECT COUNT(DISTINCT url) FROM activity) AS activity_url_count,
-                (SELECT COUNT(*) FROM page) AS fetched_count,
-                (SELECT COUNT(*) FROM fetch_error) AS error_count
+            SELECT activity_count, activity_url_count, fetched_count, error_count
+            FROM archive_stats
         """)
         (self.activity_count, self.activity_url_count, self.fetched_count, self.error_count) = c.fetchone()
 
-    def activity(self, *, extra_query=None, extra_args=(), order_by=None):
-        order_by = order_by or 'activity.loadTime DESC'
+    @property
+    def page_files(self):
+        """The set of filenames in `pages/` (relative paths, if the pages are sharded)
+
+        This is read with one directory scan the first time it's needed, and kept up to date as
+        pages are written by this process. Use `refresh_page_files()` to pick up files written
+        by another process (e.g., the saver running while you use a notebook).
+        """
+        if self._page_files is None:
+            self._page_files = pagestore.scan_page_files(self)
+        return self._page_files
+
+    @property
+    def packed_urls(self):
+        """The set of URLs whose pages are stored in pack files (see `pagestore`)"""
+        if self._packed_urls is None:
+            c = self.read_conn.cursor()
+            c.execute("SELECT url FROM page_blob")
+            self._packed_urls = set(row[0] for row in c)
+        return self._packed_urls
+
+    @property
+    def fetched_url_filter(self):
+        """A `BloomFilter` of the URLs in `page` (a URL not in it certainly hasn't been fetched), or None
+
+        The first time it's asked for, it starts being built on a background thread (see
+        `build_fetched_url_filter()`), and it is None until it's ready. After that it's kept up to
+        date as this process adds pages (see `pages_fetched()`). A URL in it still has to be checked
+        in the database.
+        """
+        if self._fetched_url_filter is None:
+            self.build_fetched_url_filter()
+        return self._fetched_url_filter
+
+    def build_fetched_url_filter(self):
+        """Starts building `fetched_url_filter` on a background thread, unless it's built or building"""
+        with self._url_filter_lock:
+            if self._fetched_url_filter is not None or self._url_filter_added is not None:
+                return
+            # URLs from pages_fetched() while it's being built:
+            self._url_filter_added = []
+        threading.Thread(target=self._build_fetched_url_filter, name="url-filter", daemon=True).start()
+
+    def _build_fetched_url_filter(self):
+        url_filter = None
+        try:
+            conn = self._connect_readonly()
+            try:
+                c = conn.cursor()
+                # Pages are added (with pages_fetched()) and committed while holding the lock, so
+                # each fetched URL is either committed before this query starts, or in
+                # self._url_filter_added:
+                with self.lock:
+                    c.execute("SELECT url FROM page")
+                urls = [row[0] for row in c]
+            finally:
+                conn.close()
+            # Room to grow, so the filter isn't rebuilt soon:
+            url_filter = BloomFilter(len(urls) * 2 + 10000)
+            url_filter.update(urls)
+        finally:
+            with self._url_filter_lock:
+                if url_filter is not None:
+                    url_filter.update(self._url_filter_added)
+                    self._fetched_url_filter = url_filter
+                self._url_filter_added = None
+
+    def pages_fetched(self, urls):
+        """Adds newly fetched URLs to `fetched_url_filter` (if it has been read, or is being built)"""
+        with self._url_filter_lock:
+            if self._url_filter_added is not None:
+                self._url_filter_added.extend(urls)
+                return
+            url_filter = self._fetched_url_filter
+            if url_filter is None:
+                return
+            url_filter.update(urls)
+            if url_filter.full:
+                # Past its capacity the filter gets too many false positives; read it again, bigger:
+                self._fetched_url_filter = None
+
+    def urls_fetched(self, urls):
+        """Returns the set of `urls` that have a row in `page`
+
+        Most URLs that haven't been fetched are ruled out by `fetched_url_filter`; only the rest are
+        looked up (with the page_url index). Until the filter is ready every URL is looked up.
+        """
+        url_filter = self.fetched_url_filter
+        if url_filter is None:
+            maybe = list(set(urls))
+        else:
+            maybe = [url for url in set(urls) if url in url_filter]
+        fetched = set()
         c = self.conn.cursor()
-        rows = c.execute("""
+        for i in range(0, len(maybe), self.sql_chunk_size):
+            chunk = maybe[i:i + self.sql_chunk_size]
+            c.execute(
+                "SELECT url FROM page WHERE url IN (%s)" % ", ".join("?" * len(chunk)),
+                chunk)
+            fetched.update(row[0] for row in c)
+        return fetched
+
+    def refresh_page_files(self):
+        pagestore.refresh_layout(self)
+        self._page_files = None
+        self._page_file_urls = None
+        self._packed_urls = None
+
+    def has_page_file(self, url):
+        """Is the page data for this URL stored, in a pack or in `pages/`?
+
+        This looks the URL up in `packed_urls` and in an index of `page_files` by URL, so it doesn't
+        have to work out the URL's filename (which means quoting, and hashing in the sharded layout).
+        That's only done for a URL that isn't found, when some page filenames were truncated.
+        """
+        if url in self.packed_urls:
+            return True
+        if self._page_file_urls is None:
+            self._page_file_urls = {pagestore.LAYOUT_FLAT: set(), pagestore.LAYOUT_SHARDED: set()}
+            self._truncated_page_files = False
+            for name in self.page_files:
+                self._index_page_file(name)
+        if url in self._page_file_urls[self.page_layout]:
+            return True
+        if self.page_layout_migrating and url in self._page_file_urls[pagestore.LAYOUT_FLAT]:
+            return True
+        if not self._truncated_page_files:
+            return False
+        name = Page.base_path(self, url) + "-page.json"
+        if name in self.page_files or name + ".zst" in self.page_files:
+            return True
+        if self.page_layout_migrating:
+            name = Page.generate_base_filename(url) + "-page.json"
+            return name in self.page_files or name + ".zst" in self.page_files
+        return False
+
+    def _index_page_file(self, name):
+        found = pagestore.page_file_url(name)
+        if found is None:
+            return
+        layout, url = found
+        if url is pagestore.TRUNCATED:
+            self._truncated_page_files = True
+        else:
+            self._page_file_urls[layout].add(url)
+
+    def page_file_added(self, filename):
+        if self._page_files is not None:
+            name = os.path.relpath(filename, self.pages_path)
+            self._page_files.add(name)
+            if self._page_file_urls is not None:
+                self._index_page_file(name)
+
+    def page_packed(self, url):
+        if self._packed_urls is not None:
+            self._packed_urls.add(url)
+
+    def activity(self, *, extra_query=None, extra_args=(), order_by=None, iterator=False, batch_size=None):
+        """Returns all activity (newest first), optionally filtered by `extra_query`
+
+        If `iterator` is true then this returns a generator that reads rows from the database
+        `batch_size` rows at a time, instead of building every Activity up front.
+        """
+        order_by = order_by or 'activity.loadTime DESC'
+        c = self.read_conn.cursor()
+        c.execute("""
             %s
             LEFT JOIN page ON page.url = activity.url
             WHERE browser.id = activity.browserId
               %s
             ORDER BY %s
         """ % (self.base_activity_sql, extra_query or "", order_by), extra_args)
-        rows = list(rows)
-        return [Activity(self, row) for row in rows]
+        return self._activities_from_cursor(c, iterator, batch_size)
 
-    def get_activity_by_url(self, *, like, order_by=None):
-        return self.activity(extra_query="AND activity.url LIKE ?", extra_args=(like,), order_by=order_by)
+    def iter_activity(self, *, extra_query=None, extra_args=(), with_page=False, after=None, reverse=False, limit=None, batch_size=None):
+        """Streams activity in a stable (loadTime, id) order, newest first
 
-    def activity_with_page(self):
-        c = self.conn.cursor()
-        rows = c.execute("""
+        This uses keyset pagination: pass `after=(activity.loadTime, activity.id)` of the last
+        activity you saw to continue from that point (e.g., `after=activity.keyset`). If `reverse` is true
+        then activity is returned oldest first, and `after` continues forward in time.
+        If `with_page` is true only activity with a fetched page is returned.
+        """
+        direction = "ASC" if reverse else "DESC"
+        query = [extra_query or ""]
+        args = list(extra_args)
+        if after is not None:
+            query.append("AND (activity.loadTime, activity.id) %s (?, ?)" % (">" if reverse else "<"))
+            args.extend(after)
+        if with_page:
+            query.append("AND page.url IS NOT NULL")
+        sql = """
+            %s
+            LEFT JOIN page ON page.url = activity.url
+            WHERE browser.id = activity.browserId
+              %s
+            ORDER BY activity.loadTime %s, activity.id %s
+        """ % (self.base_activity_sql, " ".join(query), direction, direction)
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        c = self.read_conn.cursor()
+        c.execute(sql, args)
+        return self._activities_from_cursor(c, True, batch_size)
+
+    def get_activity_by_url(self, *, like, order_by=None, iterator=False):
+        return self.activity(extra_query="AND activity.url LIKE ?", extra_args=(like,), order_by=order_by, iterator=iterator)
+
+    def activity_with_page(self, *, iterator=False, batch_size=None):
+        c = self.read_conn.cursor()
+        c.execute("""
             %s, page
             WHERE activity.url = page.url
               AND browser.id = activity.browserId
             ORDER BY activity.loadTime DESC
         """ % self.base_activity_sql)
-        return [Activity(self, row) for row in rows]
+        return self._activities_from_cursor(c, iterator, batch_size)
 
-    def get_activity_sourceId_in(self, sourceIds):
-        c = self.conn.cursor()
-        rows = c.execute("""
+    def get_activity_sourceId_in(self, sourceIds, *, iterator=False, batch_size=None):
+        c = self.read_conn.cursor()
+        c.execute("""
             %s
             LEFT JOIN page ON page.url = activity.url
             WHERE browser.id = activity.browserId
@@ -184,10 +478,26 @@ class Archive:
             ORDER BY activity.loadTime DESC
         """ % (self.base_activity_sql, ", ".join(["?"] * len(sourceIds))),
         sourceIds)
-        return [Activity(self, row) for row in rows]
+        return self._activities_from_cursor(c, iterator, batch_size)
+
+    def _activities_from_cursor(self, cursor, iterator, batch_size):
+        if iterator:
+            return self._iter_activities(cursor, batch_size or self.activity_batch_size)
+        return [Activity(self, row) for row in cursor.fetchall()]
+
+    def _iter_activities(self, cursor, batch_size):
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield Activity(self, row)
+        finally:
+            cursor.close()
 
     def get_activity(self, url):
-        c = self.conn.cursor()
+        c = self.read_conn.cursor()
         rows = c.execute("""
             %s
             LEFT JOIN page ON page.url = activity.url
@@ -197,7 +507,7 @@ class Archive:
         return Activity(self, rows.fetchone())
 
     def sample_activity_with_page(self, number, unique_url=True, unique_domain=False):
-        c = self.conn.cursor()
+        c = self.read_conn.cursor()
         rows = c.execute("""
             %s, page
             WHERE activity.url = page.url
@@ -226,6 +536,35 @@ class Archive:
             result.append(activity)
         return result
 
+    def activity_frame(self, *, extra_query=None, extra_args=(), batch_size=None):
+        """Returns the activity (newest first, optionally filtered by `extra_query`) as an `activityframe.ActivityFrame`
+
+        The frame keeps each field in a NumPy column, which takes a fraction of the memory of
+        `Activity` objects and can be filtered and grouped quickly. It needs NumPy.
+        """
+        return activityframe.read_activity_frame(
+            self, extra_query=extra_query, extra_args=extra_args, batch_size=batch_size)
+
+    def map_pages(self, fn, urls=None, *, processes=None, chunksize=50, ordered=True, reduce=None, initial=None):
+        """Calls `fn(page)` for each URL's Page (default: every fetched URL, once), in `processes` worker processes
+
+        Returns an iterator of `(url, result)`, in the order of `urls` unless `ordered` is false (then
+        results come back as they finish). If `reduce` is given, it's instead called as
+        `reduce(value, result)` for each result, starting with `initial`, and the last value is
+        returned; e.g., `archive.map_pages(count_classes, reduce=operator.add, initial=Counter())`.
+
+        URLs are sent to the workers `chunksize` at a time. `processes` defaults to the number of
+        CPUs; with `processes=1` everything runs in this process. URLs whose page data is missing are
+        skipped. `fn` must be picklable (see `pagemap`).
+        """
+        results = pagemap.map_pages(self, fn, urls, processes=processes, chunksize=chunksize, ordered=ordered)
+        if reduce is None:
+            return results
+        value = initial
+        for url, result in results:
+            value = reduce(value, result)
+        return value
+
     def get_activity_by_source(self, sourceId):
         return self.activity(extra_query="AND activity.sourceId = ?", extra_args=(sourceId,))
 
@@ -248,6 +587,11 @@ class Activity(URLMixin):
     def __repr__(self):
         return '<Activity %s %s>' % (self.id, self.url)
 
+    @property
+    def keyset(self):
+        """The position of this activity, for use with `Archive.iter_activity(after=...)`"""
+        return (self.loadTime, self.id)
+
     @property
     def following(self):
         if self._following is None:
@@ -274,13 +618,13 @@ class Activity(URLMixin):
             self.allFeeds = json.loads(row["allFeeds"])
         else:
             self.allFeeds = None
-        self.has_page = row["page_fetched"] and os.path.exists(Page.json_filename(self.archive, self.url))
+        self.has_page = bool(row["page_fetched"]) and self.archive.has_page_file(self.url)
 
     @property
     def page(self):
         if hasattr(self, "_page"):
             return self._page
-        if not os.path.exists(Page.json_filename(self.archive, self.url)):
+        if not self.archive.has_page_file(self.url):
             return None
         self._page = Page(self.archive, self.url)
         return self._page
@@ -321,11 +665,19 @@ class Page(URLMixin):
 
     @classmethod
     def json_filename(cls, archive, url):
-        return os.path.join(archive.pages_path, cls.generate_base_filename(url) + "-page.json")
+        return os.path.join(archive.pages_path, cls.base_path(archive, url) + "-page.json")
 
     @classmethod
     def annotation_filename(cls, archive, url):
-        return os.path.join(archive.pages_path, cls.generate_base_filename(url) + "-annotation.json")
+        return os.path.join(archive.pages_path, cls.base_path(archive, url) + "-annotation.json")
+
+    @classmethod
+    def base_path(cls, archive, url):
+        """The location of the URL's files, relative to `pages/` and without a suffix"""
+        name = cls.generate_base_filename(url)
+        if archive.page_layout == pagestore.LAYOUT_SHARDED:
+            return pagestore.shard_path(name)
+        return name
 
     @classmethod
     def generate_base_filename(cls, url):
@@ -335,7 +687,7 @@ class Page(URLMixin):
         return name
 
     def fetch(self):
-        c = self.archive.conn.cursor()
+        c = self.archive.read_conn.cursor()
         row = c.execute("""
             SELECT fetched, activityId, timeToFetch, redirectUrl, redirectOk
             FROM page
@@ -348,15 +700,8 @@ class Page(URLMixin):
         self.timeToFetch = row["timeToFetch"]
         self.redirectUrl = row["redirectUrl"]
         self.redirectOk = row["redirectOk"]
-        filename = self.json_filename(self.archive, self.url)
-        with open(filename) as fp:
-            self.data = json.load(fp)
-        annotation_filename = self.annotation_filename(self.archive, self.url)
-        if os.path.exists(annotation_filename):
-            with open(annotation_filename) as fp:
-                self.annotations = json.load(fp)
-        else:
-            self.annotations = {}
+        self.data = pagestore.read_page(self.archive, self.url)
+        self.annotations = pagestore.read_annotations(self.archive, self.url)
 
     @property
     def html(self):
@@ -496,7 +841,10 @@ class Feed:
 
     @property
     def parsed(self):
+        global feedparser
         if not self._parsed:
+            if feedparser is None:
+                import feedparser
             self._parsed = feedparser.parse(self.body, response_headers={"Content-Location": self.url})
         return self._parsed
 
@@ -576,61 +924,246 @@ class FeedEntry(URLMixin):
 class ActivityPool:
     """Represents a bunch of activities, and the relations between them.
 
-    This can be expensive to instantiate, but helps make it easier to evaluate interrelations
+    Use `ActivityPool.for_window()` to build a pool of the activity in a time range, or pass any
+    list of activities. Only the links from those activities are read (with the activity_link
+    index). Pages are read, and their feeds parsed, the first time something needs them (e.g.,
+    `pages`, `feeds_by_url`, or `feed_entry_by_subject_url`).
+
+    A pool from `for_window()` can be saved with `save()`, and `ActivityPool.load()` reads it back,
+    only re-reading the activity that was added or changed since.
     """
 
-    def __init__(self, archive, activities):
+    # Changed whenever the format of save() changes; older snapshots are rebuilt:
+    snapshot_version = 2
+
+    def __init__(self, archive, activities, *, links=None):
         self.archive = archive
         self.activities = activities
-        self.pages = []
         self._urls = None
         self.activities_by_id = {}
         self.activities_by_url = defaultdict(set)
         for a in self.activities:
             self.activities_by_id[a.id] = a
             self.activities_by_url[a.url].add(a)
-        self.page_by_url = {}
-        self.pages_with_feeds = []
+        self._page_by_url = None
+        self._feeds_by_url = None
+        # (start, end) for a pool from for_window(), and the archive_stats.change_seq it has read up to:
+        self.window = None
+        self._change_seq = None
+        self.link_to_url = defaultdict(set)
+        if links is None:
+            links = self._read_links(archive, list(self.activities_by_id))
+        for row in links:
+            self._add_link(row)
+        self.urls = ActivityPoolURLs(self)
+        self._domains = None
+
+    @staticmethod
+    def _read_links(archive, activity_ids):
+        """Returns `(activity_id, url, text, rel, target, elementId)` for the links of the activities"""
+        cur = archive.read_conn.cursor()
+        rows = []
+        for i in range(0, len(activity_ids), archive.sql_chunk_size):
+            chunk = activity_ids[i:i + archive.sql_chunk_size]
+            cur.execute("""
+            SELECT activity_id, url, text, rel, target, elementId
+            FROM activity_link
+            WHERE activity_id IN (%s)
+            """ % ", ".join("?" * len(chunk)), chunk)
+            rows.extend(tuple(row) for row in cur.fetchall())
+        return rows
+
+    def _add_link(self, row):
+        a = self.activities_by_id[row[0]]
+        if not hasattr(a, "links"):
+            a.links = {}
+        link = ActivityLink(a, *row[1:])
+        a.links[link.url] = link
+        if link.url in self.activities_by_url:
+            self.link_to_url[link.url].add(link)
+
+    @staticmethod
+    def _window_query(start, end, *, column="activity.loadTime"):
+        query = []
+        args = []
+        if start is not None:
+            query.append("AND %s >= ?" % column)
+            args.append(start)
+        if end is not None:
+            query.append("AND %s < ?" % column)
+            args.append(end)
+        return " ".join(query), args
+
+    @staticmethod
+    def _read_change_seq(archive):
+        c = archive.read_conn.cursor()
+        c.execute("SELECT change_seq FROM archive_stats")
+        return c.fetchone()[0]
+
+    @classmethod
+    def for_window(cls, archive, start=None, end=None):
+        """A pool of the activity loaded from `start` up to (not including) `end` (in ms, like loadTime)
+
+        Either end can be None, for no limit.
+        """
+        # Read first, so anything written while the pool is built is read again by load():
+        change_seq = cls._read_change_seq(archive)
+        query, args = cls._window_query(start, end)
+        pool = cls(archive, archive.activity(extra_query=query, extra_args=args))
+        pool.window = (start, end)
+        pool._change_seq = change_seq
+        return pool
+
+    def save(self, path):
+        """Saves the activities and links to a file, to be read with `ActivityPool.load()`
+
+        Pages and feeds aren't saved; they are still read when they are needed.
+        """
+        if self.window is None:
+            raise Exception("Only a pool from ActivityPool.for_window() can be saved")
+        skip = {"archive", "_page", "_following", "links"}
+        snapshot = {
+            "version": self.snapshot_version,
+            "schemaVersion": len(migrations.MIGRATIONS),
+            "window": self.window,
+            "changeSeq": self._change_seq,
+            "activities": [
+                {name: value for name, value in a.__dict__.items() if name not in skip}
+                for a in self.activities],
+            "links": [
+                (a.id, link.url, link.text, link.rel, link.target, link.elementId)
+                for a in self.activities for link in getattr(a, "links", {}).values()],
+        }
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "wb") as fp:
+            fp.write(zlib.compress(pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL)))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, archive, path):
+        """Reads a pool saved with `save()`, bringing it up to date with the archive
+
+        Activity that was added, changed, or deleted since the pool was built (and activity whose
+        page was fetched or deleted since) is read again, using the archive's change_log. If the
+        snapshot can't be brought up to date (it's from another version, the archive's change
+        sequence is behind it, e.g., because the archive was replaced, or the change_log was reset
+        since by `archive.update_status(recount=True)`) the pool is built from scratch.
+        """
+        with open(path, "rb") as fp:
+            snapshot = pickle.loads(zlib.decompress(fp.read()))
+        start, end = snapshot["window"]
+        c = archive.read_conn.cursor()
+        c.execute("SELECT change_seq, change_log_start FROM archive_stats")
+        change_seq, change_log_start = c.fetchone()
+        if (snapshot.get("version") != cls.snapshot_version
+                or snapshot["schemaVersion"] != len(migrations.MIGRATIONS)
+                or snapshot["changeSeq"] > change_seq
+                or snapshot["changeSeq"] < change_log_start):
+            return cls.for_window(archive, start, end)
+        activities = {}
+        for state in snapshot["activities"]:
+            a = Activity.__new__(Activity)
+            a.__dict__.update(state)
+            a.archive = archive
+            a._following = None
+            activities[a.id] = a
+        links = snapshot["links"]
+        c.execute("""
+            SELECT keys FROM change_log WHERE seq > ? AND seq <= ?
+        """, (snapshot["changeSeq"], change_seq))
+        changed_ids = set()
+        changed_urls = set()
+        for (keys,) in c:
+            for key in json.loads(keys):
+                kind, value = key.split(":", 1)
+                if kind == "activity":
+                    changed_ids.add(value)
+                else:
+                    changed_urls.add(value)
+        # Activity whose page changed has a different has_page:
+        changed_ids.update(a.id for a in activities.values() if a.url in changed_urls)
+        if changed_ids:
+            # Everything changed is read again; what isn't found was deleted or left the window:
+            for activity_id in changed_ids:
+                activities.pop(activity_id, None)
+            window_query, window_args = cls._window_query(start, end)
+            ids = list(changed_ids)
+            for i in range(0, len(ids), archive.sql_chunk_size):
+                chunk = ids[i:i + archive.sql_chunk_size]
+                for a in archive.activity(
+                        extra_query="AND activity.id IN (%s) %s" % (", ".join("?" * len(chunk)), window_query),
+                        extra_args=chunk + window_args):
+                    activities[a.id] = a
+            links = [row for row in links if row[0] not in changed_ids]
+            links.extend(cls._read_links(archive, [i for i in ids if i in activities]))
+        # Newest first, like Archive.activity():
+        ordered = sorted(
+            activities.values(), reverse=True,
+            key=lambda a: a.loadTime if a.loadTime is not None else float("-inf"))
+        pool = cls(archive, ordered, links=links)
+        pool.window = (start, end)
+        pool._change_seq = change_seq
+        return pool
+
+    def _load_pages(self):
+        self._page_by_url = {}
+        self._pages = []
         for a in self.activities:
             p = a.page
             if p:
-                self.page_by_url[p.url] = p
-                self.pages.append(p)
-        self.feeds_by_url = {}
-        self.feed_entry_by_subject_url = {}
-        self.feed_entries_without_link = []
+                self._page_by_url[p.url] = p
+                self._pages.append(p)
+
+    @property
+    def page_by_url(self):
+        if self._page_by_url is None:
+            self._load_pages()
+        return self._page_by_url
+
+    @property
+    def pages(self):
+        if self._page_by_url is None:
+            self._load_pages()
+        return self._pages
+
+    @property
+    def pages_with_feeds(self):
+        return [p for p in self.page_by_url.values() if p.feeds]
+
+    def _load_feeds(self):
+        self._feeds_by_url = {}
+        self._feed_entry_by_subject_url = {}
+        self._feed_entries_without_link = []
         for p in self.page_by_url.values():
-            if p.feeds:
-                self.pages_with_feeds.append(p)
             for feed in p.feeds:
                 if feed.errored:
                     continue
                 # FIXME: make sure the feed hasn't updated, if it was fetched at the same URL more than once
-                self.feeds_by_url[feed.url] = feed
+                self._feeds_by_url[feed.url] = feed
                 for entry in feed.entries:
                     link = entry.get("link")
                     if link:
-                        self.feed_entry_by_subject_url[link] = entry
+                        self._feed_entry_by_subject_url[link] = entry
                     else:
-                        self.feed_entries_without_link.append((entry, feed))
-        self.link_to_url = defaultdict(set)
-        cur = archive.conn.cursor()
-        cur.execute("""
-        SELECT activity_id, url, text, rel, target, elementId
-        FROM activity_link
-        """)
-        for row in cur.fetchall():
-            a = self.activities_by_id.get(row["activity_id"])
-            if not a:
-                continue
-            if not hasattr(a, "links"):
-                a.links = {}
-            link = ActivityLink(a, row["url"], row["text"], row["rel"], row["target"], row["elementId"])
-            a.links[link.url] = link
-            if link.url in self.activities_by_url:
-                self.link_to_url[link.url].add(link)
-        self.urls = ActivityPoolURLs(self)
-        self._domains = None
+                        self._feed_entries_without_link.append((entry, feed))
+
+    @property
+    def feeds_by_url(self):
+        if self._feeds_by_url is None:
+            self._load_feeds()
+        return self._feeds_by_url
+
+    @property
+    def feed_entry_by_subject_url(self):
+        if self._feeds_by_url is None:
+            self._load_feeds()
+        return self._feed_entry_by_subject_url
+
+    @property
+    def feed_entries_without_link(self):
+        if self._feeds_by_url is None:
+            self._load_feeds()
+        return self._feed_entries_without_link
 
     @property
     def domains(self):
@@ -666,10 +1199,20 @@ class URLPool(URLMixin):
         self.url = url
         self.activity_pool = activity_pool
         self.activities = activity_pool.activities_by_url[url]
-        self.page = activity_pool.page_by_url.get(url)
-        self.feed_entry = activity_pool.feed_entry_by_subject_url.get(url)
         self.backlinks = activity_pool.link_to_url.get(url, set())
 
+    @property
+    def page(self):
+        for a in self.activities:
+            p = a.page
+            if p:
+                return p
+        return None
+
+    @property
+    def feed_entry(self):
+        return self.activity_pool.feed_entry_by_subject_url.get(self.url)
+
 
 class ActivityPoolURLs(Mapping):
 
@@ -1,12 +1,60 @@
+import argparse
 from . import Archive
 
-if __name__ == "__main__":
-    import sys
-    archive = Archive.default_location()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m pha")
+    parser.add_argument("--archive", help="Location of the archive (default: $PHA_DATA or data/)")
+    commands = parser.add_subparsers(dest="command")
+    show = commands.add_parser("show", help="Show the archive status, or a page")
+    show.add_argument("url", nargs="?", help="Show the activity and page for this URL")
+    show.add_argument("--recount", action="store_true", help="Recount the archive statistics from scratch")
+    compress = commands.add_parser("compress-pages", help="Compress all page files with a trained zstd dictionary")
+    compress.add_argument("--level", type=int, default=3, help="zstd compression level")
+    compress.add_argument("--sample-size", type=int, default=1000, help="Number of pages to train the dictionary with")
+    compress.add_argument("--retrain", action="store_true", help="Train a new dictionary even if one exists")
+    shard = commands.add_parser("shard-pages", help="Move page files into hash-sharded subdirectories of pages/")
+    shard.add_argument("--threads", type=int, default=8, help="Number of files to move in parallel")
+    commands.add_parser("pack-pages", help="Move all page files into pack files")
+    compact = commands.add_parser("compact-packs", help="Reclaim the space of replaced pages in pack files")
+    compact.add_argument("--min-garbage", type=float, default=0.25, help="Only rewrite segments with at least this fraction of garbage")
+    metrics = commands.add_parser("metrics", help="Show the saver's per-handler metrics")
+    metrics.add_argument("--days", type=int, help="Only include the last DAYS days that have metrics")
+    args = parser.parse_args(argv)
+    if args.archive:
+        archive = Archive(args.archive)
+    else:
+        archive = Archive.default_location()
+    if args.command == "show" and args.recount:
+        archive.update_status(recount=True)
     print("Archive:", archive)
-    if sys.argv[1:]:
-        history = archive.get_history(sys.argv[1])
-        page = history.page
-        print("History:", history, history.visits)
+    if args.command == "compress-pages":
+        from . import pagestore
+        pagestore.compress_pages(
+            archive, level=args.level, retrain=args.retrain, sample_size=args.sample_size, verbose=True)
+    elif args.command == "shard-pages":
+        from . import pagestore
+        pagestore.shard_pages(archive, threads=args.threads, verbose=True)
+    elif args.command == "pack-pages":
+        from . import pagestore
+        pagestore.pack_pages(archive, verbose=True)
+    elif args.command == "compact-packs":
+        from . import pagestore
+        reclaimed = pagestore.compact_packs(archive, min_garbage=args.min_garbage, verbose=True)
+        print("Reclaimed %iMb" % (reclaimed / 1000000))
+    elif args.command == "metrics":
+        import os
+        from .metrics import load_metrics, format_metrics
+        data = load_metrics(os.path.join(archive.path, "metrics.json"))
+        print(format_metrics(data, days=args.days) if data else "No metrics saved yet")
+    elif args.command == "show" and args.url:
+        activity = archive.get_activity(args.url)
+        page = activity.page
+        print("Activity:", activity)
         print("Page:", page)
-        print("HTML:\n", page.html)
+        if page:
+            print("HTML:\n", page.html)
+
+
+if __name__ == "__main__":
+    main()
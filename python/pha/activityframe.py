@@ -0,0 +1,282 @@
+"""
+Activity as columns of NumPy arrays
+
+`Archive.activity_frame()` reads activity into an `ActivityFrame`. Each column is one NumPy array,
+instead of each row being an `Activity` object with ~35 attributes. The column types are:
+
+- Times and counts are int64, with `NULL_INT` where the database has NULL.
+- Text (URLs, domains, transition types, ...) is dictionary-encoded: an int32 code for each row,
+  and a list of the distinct values.
+- True/false columns are bit-packed.
+
+A million rows take well under 200MB, and filters and group-bys are vectorized:
+
+    frame = archive.activity_frame()
+    recent = frame.filter(frame["loadTime"] > cutoff)
+    typed = recent.filter(recent.isin("transitionType", ["typed", "generated"]))
+    typed.group_by("domain", "activeTime", "sum")
+
+`frame.activity(i)` and `frame.activities()` make `Activity` objects, with a query, only for the
+rows you ask for.
+
+NumPy is only needed if you use this module (`pip install numpy`).
+"""
+from urllib.parse import urlparse
+
+np = None
+
+# Stands for NULL in the int64 columns:
+NULL_INT = -(1 << 63)
+
+INT_COLUMNS = [
+    "loadTime", "unloadTime", "activeCount", "activeTime", "statusCode", "maxScroll", "documentHeight",
+    "formControlInteraction", "formTextInteraction",
+]
+FLOAT_COLUMNS = ["zoomLevel"]
+# Dictionary-encoded; "domain" is computed from "url":
+TEXT_COLUMNS = [
+    "url", "transitionType", "browserId", "sessionId", "closedReason", "method", "contentType",
+]
+BOOL_COLUMNS = [
+    "client_redirect", "server_redirect", "forward_back", "from_address_bar", "newTab", "hasSetCookie",
+    "hasCookie", "isHashChange", "hashPointsToElement",
+]
+
+GROUP_AGGREGATES = ["count", "sum", "mean", "min", "max"]
+
+
+def _import_numpy():
+    global np
+    if np is None:
+        import numpy as np
+    return np
+
+
+def _domain(url, www_regex):
+    # Like pha.domain(), but None for URLs without a hostname (e.g., about:blank):
+    d = urlparse(url).hostname if url else None
+    if not d:
+        return None
+    match = www_regex.search(d)
+    if match:
+        d = d[match.end():]
+    return d.lower()
+
+
+def read_activity_frame(archive, *, extra_query=None, extra_args=(), batch_size=None):
+    """Reads activity (newest first, optionally filtered by `extra_query`) into an ActivityFrame"""
+    from . import www_regex
+    _import_numpy()
+    batch_size = batch_size or archive.activity_batch_size
+    c = archive.read_conn.cursor()
+    c.execute("""
+        SELECT
+            activity.id,
+            %s,
+            page.fetched IS NOT NULL AS has_page
+        FROM activity, browser
+        LEFT JOIN page ON page.url = activity.url
+        WHERE browser.id = activity.browserId
+          %s
+        ORDER BY activity.loadTime DESC
+    """ % (
+        ", ".join("activity.%s" % name for name in INT_COLUMNS + FLOAT_COLUMNS + TEXT_COLUMNS + BOOL_COLUMNS),
+        extra_query or ""), extra_args)
+    bool_names = BOOL_COLUMNS + ["has_page"]
+    encoders = {name: {} for name in TEXT_COLUMNS}
+    chunks = {name: [] for name in ["id"] + INT_COLUMNS + FLOAT_COLUMNS + TEXT_COLUMNS + bool_names}
+    while True:
+        rows = c.fetchmany(batch_size)
+        if not rows:
+            break
+        # Rows are tuples of (id, ints..., floats..., texts..., bools...):
+        columns = list(zip(*[tuple(row) for row in rows]))
+        pos = 0
+        chunks["id"].append(np.array(columns[pos], dtype="S"))
+        pos += 1
+        for name in INT_COLUMNS:
+            chunks[name].append(np.array(
+                [NULL_INT if value is None else value for value in columns[pos]], dtype=np.int64))
+            pos += 1
+        for name in FLOAT_COLUMNS:
+            chunks[name].append(np.array(
+                [np.nan if value is None else value for value in columns[pos]], dtype=np.float64))
+            pos += 1
+        for name in TEXT_COLUMNS:
+            encoder = encoders[name]
+            chunks[name].append(np.array(
+                [encoder.setdefault(value, len(encoder)) for value in columns[pos]], dtype=np.int32))
+            pos += 1
+        for name in bool_names:
+            chunks[name].append(np.array([bool(value) for value in columns[pos]], dtype=bool))
+            pos += 1
+    length = sum(len(chunk) for chunk in chunks["id"])
+
+    def concatenate(name, dtype):
+        if not chunks[name]:
+            return np.zeros(0, dtype=dtype)
+        return np.concatenate(chunks[name])
+
+    ids = concatenate("id", "S1")
+    arrays = {}
+    for name in INT_COLUMNS:
+        arrays[name] = concatenate(name, np.int64)
+    for name in FLOAT_COLUMNS:
+        arrays[name] = concatenate(name, np.float64)
+    codes = {}
+    categories = {}
+    for name in TEXT_COLUMNS:
+        codes[name] = concatenate(name, np.int32)
+        categories[name] = list(encoders[name])
+    # Each distinct URL's domain is only computed once:
+    domain_encoder = {}
+    url_to_domain = np.array(
+        [domain_encoder.setdefault(_domain(url, www_regex), len(domain_encoder)) for url in categories["url"]],
+        dtype=np.int32)
+    codes["domain"] = url_to_domain[codes["url"]]
+    categories["domain"] = list(domain_encoder)
+    packed = {name: np.packbits(concatenate(name, bool)) for name in bool_names}
+    return ActivityFrame(archive, length, ids, arrays, codes, categories, packed)
+
+
+class ActivityFrame:
+
+    def __init__(self, archive, length, ids, arrays, codes, categories, packed):
+        self.archive = archive
+        self._length = length
+        # Activity ids, as bytes:
+        self._ids = ids
+        # int64 and float64 columns:
+        self._arrays = arrays
+        # Dictionary-encoded columns: the codes, and the value of each code:
+        self._codes = codes
+        self._categories = categories
+        # Bit-packed bool columns:
+        self._packed = packed
+
+    def __repr__(self):
+        return '<ActivityFrame %i rows>' % self._length
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def columns(self):
+        return ["id"] + list(self._arrays) + list(self._codes) + list(self._packed)
+
+    def __getitem__(self, name):
+        """The column as an array (text columns are decoded into an array of str/None)"""
+        if name == "id":
+            return self._ids.astype(str)
+        if name in self._arrays:
+            return self._arrays[name]
+        if name in self._codes:
+            return np.array(self._categories[name], dtype=object)[self._codes[name]]
+        if name in self._packed:
+            return np.unpackbits(self._packed[name], count=self._length).astype(bool)
+        raise KeyError("No column %r" % name)
+
+    def codes(self, name):
+        """Returns `(codes, values)` for a dictionary-encoded column"""
+        return self._codes[name], self._categories[name]
+
+    def isnull(self, name):
+        if name in self._arrays:
+            column = self._arrays[name]
+            if column.dtype == np.float64:
+                return np.isnan(column)
+            return column == NULL_INT
+        if name in self._codes:
+            return self.equals(name, None)
+        raise KeyError("Column %r can't be null" % name)
+
+    def equals(self, name, value):
+        """A mask of the rows where the column is `value`"""
+        return self.isin(name, [value])
+
+    def isin(self, name, values):
+        """A mask of the rows where the column is one of `values`"""
+        if name in self._codes:
+            lookup = {value: code for code, value in enumerate(self._categories[name])}
+            wanted = [lookup[value] for value in values if value in lookup]
+            return np.isin(self._codes[name], np.array(wanted, dtype=np.int32))
+        return np.isin(self[name], list(values))
+
+    def filter(self, selection):
+        """A new frame of the rows in `selection` (a boolean mask, or an array of row numbers)"""
+        selection = np.asarray(selection)
+        if selection.dtype == bool:
+            selection = np.flatnonzero(selection)
+        packed = {
+            name: np.packbits(np.unpackbits(bits, count=self._length).astype(bool)[selection])
+            for name, bits in self._packed.items()}
+        return ActivityFrame(
+            self.archive, len(selection), self._ids[selection],
+            {name: column[selection] for name, column in self._arrays.items()},
+            {name: codes[selection] for name, codes in self._codes.items()},
+            self._categories, packed)
+
+    def group_by(self, key, value=None, aggregate="count"):
+        """Returns `{key_value: result}`: the `aggregate` of the `value` column for each value of `key`
+
+        `aggregate` is one of `GROUP_AGGREGATES`; for "count" no `value` is needed. NULL values aren't
+        included in the result, and a group with no values gets None (except for "count").
+        """
+        if aggregate not in GROUP_AGGREGATES:
+            raise ValueError("Unknown aggregate %r (use one of %s)" % (aggregate, ", ".join(GROUP_AGGREGATES)))
+        if key in self._codes:
+            groups = self._codes[key]
+            keys = self._categories[key]
+        else:
+            keys, groups = np.unique(self[key], return_inverse=True)
+            keys = keys.tolist()
+        size = len(keys)
+        present = np.bincount(groups, minlength=size)
+        if aggregate == "count" and value is None:
+            return {keys[i]: int(present[i]) for i in np.flatnonzero(present)}
+        if value in self._codes:
+            raise ValueError("Can't aggregate text column %r" % value)
+        values = self[value]
+        valid = ~self.isnull(value) if value in self._arrays else np.ones(len(values), dtype=bool)
+        groups_valid = groups[valid]
+        values = values[valid].astype(np.float64)
+        counts = np.bincount(groups_valid, minlength=size)
+        if aggregate == "count":
+            result = counts
+        elif aggregate in ("sum", "mean"):
+            result = np.bincount(groups_valid, weights=values, minlength=size)
+            if aggregate == "mean":
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    result = result / counts
+        else:
+            ufunc = np.minimum if aggregate == "min" else np.maximum
+            result = np.full(size, np.inf if aggregate == "min" else -np.inf)
+            ufunc.at(result, groups_valid, values)
+        output = {}
+        for i in np.flatnonzero(present):
+            if aggregate == "count":
+                output[keys[i]] = int(result[i])
+            else:
+                output[keys[i]] = float(result[i]) if counts[i] else None
+        return output
+
+    def activity(self, index):
+        """The Activity for row `index`, read from the archive"""
+        return next(self.activities([index]))
+
+    def activities(self, indexes=None):
+        """Yields the Activity of each row in `indexes` (default: all), reading them in batches"""
+        if indexes is None:
+            indexes = range(self._length)
+        ids = [self._ids[i].decode("UTF-8") for i in indexes]
+        size = self.archive.sql_chunk_size
+        for start in range(0, len(ids), size):
+            chunk = ids[start:start + size]
+            distinct = list(set(chunk))
+            by_id = {}
+            for a in self.archive.activity(
+                    extra_query="AND activity.id IN (%s)" % ", ".join("?" * len(distinct)),
+                    extra_args=distinct):
+                by_id[a.id] = a
+            for activity_id in chunk:
+                yield by_id[activity_id]
@@ -0,0 +1,53 @@
+"""
+A Bloom filter of strings
+
+A Bloom filter answers "have I seen this string?" with either "no" (certainly) or "maybe" (wrong about
+`error_rate` of the time), in about 10 bits per string. The saver keeps one of fetched page URLs, so
+most URLs that haven't been fetched are answered without a query.
+"""
+import math
+import hashlib
+
+
+class BloomFilter:
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def __repr__(self):
+        return '<BloomFilter %i/%i items, %i bits>' % (self.count, self.capacity, self.size)
+
+    def _positions(self, item):
+        # Double hashing: two 64-bit hashes make all `self.hashes` positions
+        digest = hashlib.blake2b(item.encode("UTF-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        bits = self._bits
+        for position in self._positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        bits = self._bits
+        for position in self._positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def full(self):
+        """True when more items have been added than the filter was sized for"""
+        return self.count > self.capacity
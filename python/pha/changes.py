@@ -0,0 +1,134 @@
+"""
+Bookkeeping for writes to the activity, page, and fetch_error tables
+
+`archive_stats` has the counters that `Archive.update_status()` reads, and `change_seq`, which goes
+up by one each time changes to activity or pages are saved; `change_log` has a row for each of
+those, with the activity ids and page URLs that changed (including deleted ones), which
+`ActivityPool.load()` uses to re-read only what changed since a snapshot. `activity_url_stats` has
+the number of activities of each URL, to keep the count of distinct URLs.
+
+These aren't kept up to date by triggers, which would add several writes to every row. Instead the
+code that writes those tables says what it did, and saves it with a few statements before it
+commits:
+
+    changes = Changes()
+    changes.activities_removed(deleted_rows)
+    changes.activities_added(inserted_rows)
+    changes.save(archive)
+
+Anything that writes those tables without doing this (e.g., a notebook) should call
+`archive.update_status(recount=True)` afterwards, which recounts everything and marks saved
+`ActivityPool` snapshots as out of date.
+"""
+import json
+from collections import Counter
+
+
+class Changes:
+    """What a transaction did to activity, page, and fetch_error, recorded with `save()`"""
+
+    def __init__(self):
+        # How many activities each URL gained (or lost):
+        self.url_activities = Counter()
+        self.activity_ids = set()
+        self.page_urls = set()
+        self.pages = 0
+        self.errors = 0
+
+    def __repr__(self):
+        return '<Changes %i activities, %i pages, %+i errors>' % (
+            len(self.activity_ids), len(self.page_urls), self.errors)
+
+    def activities_added(self, rows):
+        """`(id, url)` of each activity row that was inserted"""
+        for activity_id, url in rows:
+            self.url_activities[url] += 1
+            self.activity_ids.add(activity_id)
+
+    def activities_removed(self, rows):
+        """`(id, url)` of each activity row that was deleted, or replaced (by INSERT OR REPLACE)"""
+        for activity_id, url in rows:
+            self.url_activities[url] -= 1
+            self.activity_ids.add(activity_id)
+
+    def activities_updated(self, ids):
+        """Activity rows that were updated, without changing their URL"""
+        self.activity_ids.update(ids)
+
+    def pages_added(self, urls):
+        """The URL of each page row that was inserted"""
+        for url in urls:
+            self.pages += 1
+            self.page_urls.add(url)
+
+    def pages_removed(self, urls):
+        """The URL of each page row that was deleted or replaced"""
+        for url in urls:
+            self.pages -= 1
+            self.page_urls.add(url)
+
+    def errors_added(self, count):
+        """`count` fetch_error rows were inserted (or, if negative, deleted)"""
+        self.errors += count
+
+    def save(self, archive):
+        """Updates archive_stats, activity_url_stats, and change_log, in the current transaction"""
+        keys = ["activity:%s" % activity_id for activity_id in self.activity_ids]
+        keys.extend("page:%s" % url for url in self.page_urls)
+        if not keys and not self.errors:
+            return
+        c = archive.conn.cursor()
+        deltas = {url: delta for url, delta in self.url_activities.items() if delta}
+        urls = list(deltas)
+        counts = {}
+        for i in range(0, len(urls), archive.sql_chunk_size):
+            chunk = urls[i:i + archive.sql_chunk_size]
+            c.execute("""
+                SELECT url, activities FROM activity_url_stats WHERE url IN (%s)
+            """ % ", ".join("?" * len(chunk)), chunk)
+            counts.update((row[0], row[1]) for row in c.fetchall())
+        url_count = 0
+        updated = []
+        deleted = []
+        for url, delta in deltas.items():
+            old = counts.get(url, 0)
+            new = old + delta
+            url_count += (new > 0) - (old > 0)
+            if new > 0:
+                updated.append((url, new))
+            else:
+                deleted.append((url,))
+        c.executemany("""
+            INSERT INTO activity_url_stats (url, activities) VALUES (?, ?)
+            ON CONFLICT (url) DO UPDATE SET activities = excluded.activities
+        """, updated)
+        c.executemany("""
+            DELETE FROM activity_url_stats WHERE url = ?
+        """, deleted)
+        c.execute("""
+            UPDATE archive_stats SET
+              activity_count = activity_count + ?,
+              activity_url_count = activity_url_count + ?,
+              fetched_count = fetched_count + ?,
+              error_count = error_count + ?,
+              change_seq = change_seq + ?
+        """, (sum(deltas.values()), url_count, self.pages, self.errors, 1 if keys else 0))
+        if keys:
+            # One row for all of them, instead of a write for every row that changed:
+            c.execute("""
+                INSERT INTO change_log (seq, keys) SELECT change_seq, ? FROM archive_stats
+            """, (json.dumps(keys),))
+
+
+def forget_changes(c):
+    """Marks every `ActivityPool` snapshot saved so far as out of date
+
+    For after activity or pages were changed without recording it. change_log is emptied, because
+    it can't be trusted anymore (this is also the way to make it smaller).
+    """
+    c.execute("""
+        UPDATE archive_stats SET
+          change_seq = change_seq + 1,
+          change_log_start = change_seq + 1
+    """)
+    c.execute("DELETE FROM change_log")
@@ -0,0 +1,141 @@
+"""
+The sqlite connection class used by `Archive`
+
+`ArchiveConnection` is a normal `sqlite3.Connection`, except that its cursors can time the database
+work done on a thread: call `start_db_timer()`, do some work, and `stop_db_timer()` returns the
+seconds spent in `execute()`, `executemany()`, the `fetch*()` methods, and `commit()`. (Iterating
+over a cursor directly isn't counted.) The saver uses this for the `dbTime` of each handler.
+
+It also supports batches: inside `with conn.batch():` everything happens in one transaction, and
+`commit()` does nothing until the block ends. Use `with conn.savepoint():` inside a batch to undo
+just part of the work if it fails. The saver's `batch` message uses these. Work that must wait
+until the data is really committed (like deleting files the new rows replace) goes through
+`after_commit()`.
+"""
+import time
+import contextlib
+import sqlite3
+import threading
+
+_local = threading.local()
+
+
+def start_db_timer():
+    """Starts timing the database work on this thread; pass the result to `stop_db_timer()`
+
+    Timers can be nested: the time of an inner timer also counts for the outer one.
+    """
+    outer = getattr(_local, "db_time", None)
+    _local.db_time = 0.0
+    return outer
+
+
+def stop_db_timer(outer=None):
+    """Returns the time spent in the database since `start_db_timer()` on this thread"""
+    db_time = getattr(_local, "db_time", None) or 0.0
+    _local.db_time = None if outer is None else outer + db_time
+    return db_time
+
+
+def _timed(method):
+    def timed_method(self, *args, **kwargs):
+        if getattr(_local, "db_time", None) is None:
+            return method(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            _local.db_time += time.perf_counter() - start
+    timed_method.__name__ = method.__name__
+    timed_method.__doc__ = method.__doc__
+    return timed_method
+
+
+class TimingCursor(sqlite3.Cursor):
+    execute = _timed(sqlite3.Cursor.execute)
+    executemany = _timed(sqlite3.Cursor.executemany)
+    executescript = _timed(sqlite3.Cursor.executescript)
+    fetchone = _timed(sqlite3.Cursor.fetchone)
+    fetchmany = _timed(sqlite3.Cursor.fetchmany)
+    fetchall = _timed(sqlite3.Cursor.fetchall)
+
+
+class ArchiveConnection(sqlite3.Connection):
+
+    # The thread that has a batch() open, and the callbacks to run when it commits:
+    _batch_thread = None
+    _after_commit = ()
+
+    @property
+    def in_batch(self):
+        """True inside batch(), on the thread that opened it"""
+        return self._batch_thread == threading.get_ident()
+
+    def cursor(self, factory=TimingCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection's own versions of these don't go through cursor():
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    commit_now = _timed(sqlite3.Connection.commit)
+
+    def commit(self):
+        """Commits, unless a batch is open, in which case the batch commits when it ends"""
+        if not self.in_batch:
+            self.commit_now()
+
+    def after_commit(self, callback):
+        """Calls `callback()` once what has been done so far is committed
+
+        Outside a batch that is right away (the caller has committed). Inside one it's when the
+        batch commits, and never if the batch (or the savepoint the call is in) is rolled back.
+        """
+        if self.in_batch:
+            self._after_commit.append(callback)
+        else:
+            callback()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Runs the block in one transaction, which is committed at the end (or rolled back on an error)"""
+        if self._batch_thread is not None:
+            raise Exception("Batches can't be nested")
+        if not self.in_transaction:
+            self.execute("BEGIN")
+        self._batch_thread = threading.get_ident()
+        self._after_commit = []
+        try:
+            yield
+        except BaseException:
+            self._batch_thread = None
+            self._after_commit = ()
+            self.rollback()
+            raise
+        self._batch_thread = None
+        callbacks, self._after_commit = self._after_commit, ()
+        self.commit_now()
+        for callback in callbacks:
+            callback()
+
+    @contextlib.contextmanager
+    def savepoint(self, name="batch_call"):
+        """Undoes the block's changes if it raises an exception (which is then re-raised)"""
+        self.execute("SAVEPOINT %s" % name)
+        pending = len(self._after_commit)
+        try:
+            yield
+        except BaseException:
+            self.execute("ROLLBACK TO %s" % name)
+            self.execute("RELEASE %s" % name)
+            if self.in_batch:
+                del self._after_commit[pending:]
+            raise
+        self.execute("RELEASE %s" % name)
@@ -0,0 +1,73 @@
+"""
+Runs native-messaging handlers concurrently
+
+A reader thread decodes incoming messages. Most handlers run one at a time, in the order their
+messages arrived, on a single database thread. Handlers marked with `handler.concurrent = True`
+run on a pool of worker threads instead, so cheap calls (like `check_page_needed`) don't wait
+behind slow ones (like writing a large page). Those handlers must hold the archive's lock
+while they use the database themselves.
+
+Replies are sent as handlers finish, so they may be out of order; the extension matches
+replies to calls by their `id`.
+"""
+import sys
+import queue
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Dispatcher:
+
+    def __init__(self, handle_message, is_concurrent, *, workers=4, max_pending=32):
+        """`handle_message(message)` returns the reply to send (or None), and `is_concurrent(message)`
+        says if it can be run on the worker pool. At most `max_pending` messages are read before
+        their replies are sent.
+        """
+        self.handle_message = handle_message
+        self.is_concurrent = is_concurrent
+        self.workers = workers
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._messages = queue.Queue()
+        self._send_lock = threading.Lock()
+
+    def run(self, get_message, send_message):
+        """Handles messages from `get_message()` until it returns None"""
+        reader = threading.Thread(target=self._read, args=(get_message,), name="message-reader", daemon=True)
+        reader.start()
+        db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="handler")
+        try:
+            while True:
+                message = self._messages.get()
+                if message is None:
+                    break
+                executor = pool if self.is_concurrent(message) else db_executor
+                executor.submit(self._handle, message, send_message)
+        finally:
+            db_executor.shutdown(wait=True)
+            pool.shutdown(wait=True)
+
+    def _read(self, get_message):
+        try:
+            while True:
+                self._pending.acquire()
+                message = get_message()
+                if message is None:
+                    break
+                self._messages.put(message)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            self._messages.put(None)
+
+    def _handle(self, message, send_message):
+        try:
+            reply = self.handle_message(message)
+            if reply is not None:
+                with self._send_lock:
+                    send_message(reply)
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            self._pending.release()
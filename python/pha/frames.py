@@ -0,0 +1,98 @@
+"""
+Reads and writes native-messaging frames: a 4-byte native-endian length, then that much UTF-8 JSON
+
+`FrameReader` reads each frame into a buffer that it reuses, and parses the JSON straight from that
+buffer. A large message (like a 10MB scraped page) isn't first copied into a bytes object and then
+a str. If [orjson](https://github.com/ijl/orjson) is installed it's used to parse and serialize,
+and it works on the UTF-8 bytes directly. Otherwise the json module parses a str decoded from the
+buffer.
+"""
+import json
+import struct
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+length_struct = struct.Struct("@I")
+
+# Buffers up to this size are kept for the next frame; a bigger one is only used for its own frame:
+MAX_RETAINED_BUFFER = 1 << 22
+
+
+def loads(data):
+    """Parses JSON from a bytes-like object (including a memoryview)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(str(data, "utf-8"))
+
+
+def dumps(obj):
+    """Serializes to UTF-8 JSON bytes"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # orjson is stricter than json, e.g., about integers over 64 bits
+            pass
+    return json.dumps(obj).encode("utf-8")
+
+
+class FrameReader:
+
+    def __init__(self, fp, *, buffer_size=1 << 16):
+        self.fp = fp
+        self._buffer = bytearray(buffer_size)
+
+    def read_frame(self):
+        """Returns a memoryview of the next frame's content, or None at the end of the stream
+
+        The memoryview is only good until the next call; release it when you're done with it.
+        """
+        header = self.fp.read(length_struct.size)
+        if not header:
+            return None
+        if len(header) < length_struct.size:
+            raise EOFError("Native message header was cut off")
+        length = length_struct.unpack(header)[0]
+        buffer = self._buffer
+        if length > len(buffer):
+            buffer = bytearray(length)
+            if length <= MAX_RETAINED_BUFFER:
+                self._buffer = buffer
+        view = memoryview(buffer)[:length]
+        pos = 0
+        while pos < length:
+            with view[pos:] as rest:
+                read = self.fp.readinto(rest)
+            if not read:
+                view.release()
+                raise EOFError("Native message was cut off after %i of %i bytes" % (pos, length))
+            pos += read
+        return view
+
+    def read_message(self):
+        """Returns the next message, or None at the end of the stream"""
+        view = self.read_frame()
+        if view is None:
+            return None
+        return loads_view(view)
+
+
+def loads_view(view):
+    """Parses the JSON in a memoryview from `FrameReader.read_frame()`, and releases the view
+
+    With the json module the view is decoded to a str and released before the str is parsed, so a
+    buffer that isn't kept can be freed first.
+    """
+    with view:
+        if orjson is not None:
+            return orjson.loads(view)
+        text = str(view, "utf-8")
+    return json.loads(text)
+
+
+def encode_frame(obj):
+    content = dumps(obj)
+    return length_struct.pack(len(content)) + content
@@ -5,13 +5,12 @@ Mostly normalize_classes()
 """
 import re
 import random
-from nltk.stem import PorterStemmer
-import lxml
 from urllib.parse import urlparse, parse_qsl
 
 mixed_regex = re.compile(r'([a-z])([A-Z])')
 non_char_regex = re.compile(r'[^a-z\-]', re.I)
-stemmer = PorterStemmer()
+# NLTK is slow to import, so the stemmer is created on first use:
+stemmer = None
 
 
 def wordify_class(c):
@@ -24,6 +23,10 @@ def wordify_class(c):
 
 
 def stem_words(c):
+    global stemmer
+    if stemmer is None:
+        from nltk.stem import PorterStemmer
+        stemmer = PorterStemmer()
     return "-".join([stemmer.stem(w) for w in c.split("-")])
 
 
@@ -42,6 +45,7 @@ def normalize_classes(c, shuffle=False):
 
     If `shuffle` is true, then (if there is more than one class), the classes will be randomly shuffled.
     """
+    import lxml.etree
     if isinstance(c, lxml.etree.ElementBase):
         c = c.get("class")
     if not c:
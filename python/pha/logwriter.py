@@ -0,0 +1,200 @@
+"""
+Writes `addon.log` from a background thread
+
+Calling `LogWriter.log()` only checks the level and puts the arguments on a queue; formatting
+(`pprint`) and writing happen on the writer thread, which keeps the file open, writes messages in
+batches, and rotates the file when it gets too big. Because formatting happens later, don't
+change an object after you've logged it.
+
+Set `$PHA_LOG_LEVEL` to one of `LEVELS` to control what gets written (default `log`). browsinglab
+uses this module too, with `$BROWSINGLAB_LOG_LEVEL`.
+"""
+import os
+import re
+import json
+import time
+import queue
+import pprint
+import atexit
+import threading
+
+LEVELS = {
+    "debug": 10,
+    "log": 20,
+    "info": 20,
+    "warn": 30,
+    "error": 40,
+    "s_err": 40,
+}
+
+DEFAULT_LEVEL = os.environ.get("PHA_LOG_LEVEL", "log")
+
+log_writers = {}
+# Handlers log from several threads; this keeps them from each making a writer for the same file:
+_log_writers_lock = threading.Lock()
+
+
+def get_log_writer(filename, *, level=DEFAULT_LEVEL):
+    """Returns the (shared) LogWriter for this file (`level` is only used when it is created)"""
+    with _log_writers_lock:
+        if filename not in log_writers:
+            log_writers[filename] = LogWriter(filename, level=level)
+        return log_writers[filename]
+
+
+def format_record(created, level, stack, args):
+    lines = []
+    if stack:
+        log_location = stack.splitlines()[0]
+        log_location = re.sub(r'moz-extension://[a-f0-9-]+/', '/', log_location)
+    else:
+        log_location = ""
+    lines.append("Log/{: <5} {} {}".format(level, int(created * 1000), log_location))
+    if len(str(args)) < 70 and len(args) > 1:
+        args = (args,)
+    for arg in args:
+        if isinstance(arg, str):
+            s = arg
+        else:
+            s = pprint.pformat(arg, compact=True)
+            if isinstance(arg, tuple):
+                s = s[1:-1]
+        for line in s.splitlines():
+            lines.append("    %s" % line)
+    if not args:
+        lines.append("    (no arguments)")
+    return "\n".join(lines) + "\n\n"
+
+
+# The most characters of each argument that describe_message() shows:
+PREVIEW_LIMIT = 200
+
+
+def describe_message(message, limit=100):
+    """A short description of the message, like `name("arg", key={...})`, for logging
+
+    Arguments are previewed with `preview()`, not serialized, so this is cheap even for a whole page.
+    """
+    args = [preview(arg) for arg in message.get("args", ())]
+    args.extend("%s=%s" % (name, preview(value)) for name, value in message.get("kwargs", {}).items())
+    description = "%s(%s)" % (message.get("name"), ", ".join(args))
+    if len(description) > limit:
+        description = description[:limit - 15] + " ... " + description[-10:]
+    return description
+
+
+def preview(value, limit=PREVIEW_LIMIT):
+    """JSON-like text for the value, that stops after about `limit` characters"""
+    if isinstance(value, str):
+        if len(value) > limit:
+            return json.dumps(value[:limit])[:-1] + '..."'
+        return json.dumps(value)
+    if isinstance(value, (dict, list, tuple)):
+        is_dict = isinstance(value, dict)
+        parts = []
+        size = 2
+        for item in value:
+            if size >= limit:
+                parts.append("...")
+                break
+            if is_dict:
+                part = "%s: %s" % (preview(str(item), limit - size), preview(value[item], limit - size))
+            else:
+                part = preview(item, limit - size)
+            parts.append(part)
+            size += len(part) + 2
+        return ("{%s}" if is_dict else "[%s]") % ", ".join(parts)
+    if value is None or isinstance(value, (bool, int, float)):
+        return json.dumps(value)
+    return repr(value)[:limit]
+
+
+class LogWriter:
+
+    def __init__(self, filename, *, level=DEFAULT_LEVEL, max_bytes=10000000, backup_count=3, max_queue=10000):
+        self.filename = filename
+        self.level = LEVELS[level]
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._fp = None
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __repr__(self):
+        return '<LogWriter %s>' % self.filename
+
+    def enabled(self, level):
+        return LEVELS.get(level, LEVELS["error"]) >= self.level
+
+    def log(self, *args, level="log", stack=None):
+        if not self.enabled(level):
+            return
+        self.put_record((time.time(), level, stack, args))
+
+    def put_record(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            # Better to lose log messages than to block a response to the browser
+            self.dropped += 1
+
+    def flush(self, timeout=None):
+        """Waits until everything logged so far has been written"""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            # Write everything that's waiting, then flush once:
+            while not self._queue.empty() and len(items) < 1000:
+                items.append(self._queue.get_nowait())
+            for item in items:
+                if item is None:
+                    self._close_file()
+                    return
+                if isinstance(item, threading.Event):
+                    if self._fp:
+                        self._fp.flush()
+                    item.set()
+                    continue
+                try:
+                    self._write(format_record(*item))
+                except Exception as e:
+                    self._write("Log/error Could not format log message: %s\n\n" % e)
+            if self._fp:
+                self._fp.flush()
+
+    def _write(self, text):
+        if self._fp is None:
+            self._fp = open(self.filename, "a")
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            self._fp.write("Log/warn  %i log messages dropped\n\n" % dropped)
+        self._fp.write(text)
+        if self._fp.tell() > self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._close_file()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists("%s.%i" % (self.filename, i)):
+                os.replace("%s.%i" % (self.filename, i), "%s.%i" % (self.filename, i + 1))
+        if self.backup_count:
+            os.replace(self.filename, "%s.1" % self.filename)
+        else:
+            os.unlink(self.filename)
+
+    def _close_file(self):
+        if self._fp:
+            self._fp.close()
+            self._fp = None
@@ -0,0 +1,198 @@
+"""
+Counts and times the saver's message handlers
+
+For each handler name, and each (local) day, `Metrics` keeps the number of calls and errors, the
+total and maximum time, a histogram of latencies (`HISTOGRAM_BOUNDS_MS`), the bytes of messages and
+replies, and the time spent in the database. The saver saves them to `metrics.json` in the archive
+now and then, and when it exits, adding to what earlier runs saved.
+
+Get them with the `get_metrics` message, or `python -m pha metrics`. browsinglab's connector keeps
+them the same way (see `blab metrics`).
+"""
+import os
+import json
+import time
+import threading
+
+# The upper bounds of the histogram buckets, in milliseconds; the last bucket is everything slower:
+HISTOGRAM_BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+STAT_FIELDS = ["count", "errors", "time", "maxTime", "dbTime", "bytesIn", "bytesOut"]
+
+
+def new_stats():
+    stats = dict.fromkeys(STAT_FIELDS, 0)
+    stats["histogram"] = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+    return stats
+
+
+def add_stats(stats, other):
+    for field in STAT_FIELDS:
+        if field == "maxTime":
+            stats[field] = max(stats[field], other.get(field, 0))
+        else:
+            stats[field] += other.get(field, 0)
+    for i, count in enumerate(other.get("histogram", [])[:len(stats["histogram"])]):
+        stats["histogram"][i] += count
+
+
+def histogram_bucket(elapsed):
+    ms = elapsed * 1000
+    for i, bound in enumerate(HISTOGRAM_BOUNDS_MS):
+        if ms <= bound:
+            return i
+    return len(HISTOGRAM_BOUNDS_MS)
+
+
+def histogram_percentile(histogram, fraction):
+    """The bucket bound (in ms) that `fraction` of the calls were at or under (None for the last bucket)"""
+    target = sum(histogram) * fraction
+    seen = 0
+    for i, count in enumerate(histogram):
+        seen += count
+        if count and seen >= target:
+            return HISTOGRAM_BOUNDS_MS[i] if i < len(HISTOGRAM_BOUNDS_MS) else None
+    return 0
+
+
+class Metrics:
+
+    def __init__(self, filename=None, *, save_interval=60):
+        self.filename = None
+        self.save_interval = save_interval
+        # {"YYYY-MM-DD": {handler_name: stats}}
+        self.days = {}
+        self._lock = threading.Lock()
+        # The handler names of messages we haven't replied to, by message id:
+        self._names = {}
+        self._last_save = time.time()
+        if filename:
+            self.attach(filename)
+
+    def __repr__(self):
+        return '<Metrics %s>' % self.filename
+
+    def attach(self, filename):
+        """Saves to `filename` from now on, adding what was saved there before
+
+        If the metrics were already being saved to another file, they are saved there first and
+        then start again from nothing.
+        """
+        if self.filename and filename != self.filename:
+            self.save()
+            with self._lock:
+                self.days = {}
+        saved = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename) as fp:
+                    saved = json.load(fp).get("days", {})
+            except ValueError:
+                # A corrupt file isn't worth failing over; start again
+                saved = {}
+        with self._lock:
+            for day, handlers in saved.items():
+                for name, stats in handlers.items():
+                    add_stats(self._stats(name, day), stats)
+            self.filename = filename
+
+    def _stats(self, name, day=None):
+        if day is None:
+            day = time.strftime("%Y-%m-%d")
+        handlers = self.days.setdefault(day, {})
+        if name not in handlers:
+            handlers[name] = new_stats()
+        return handlers[name]
+
+    def message_received(self, message, size):
+        name = message.get("name") or "(unknown)"
+        with self._lock:
+            self._names[message.get("id")] = name
+            self._stats(name)["bytesIn"] += size
+
+    def reply_sent(self, reply, size):
+        with self._lock:
+            name = self._names.pop(reply.get("id"), None) or "(unknown)"
+            self._stats(name)["bytesOut"] += size
+
+    def record(self, name, elapsed, *, db_time=0.0, error=False):
+        """Records one call of the handler `name` that took `elapsed` seconds"""
+        with self._lock:
+            stats = self._stats(name)
+            stats["count"] += 1
+            stats["errors"] += bool(error)
+            stats["time"] += elapsed
+            stats["maxTime"] = max(stats["maxTime"], elapsed)
+            stats["dbTime"] += db_time
+            stats["histogram"][histogram_bucket(elapsed)] += 1
+            save = self.filename and time.time() - self._last_save > self.save_interval
+        if save:
+            self.save()
+
+    def as_json(self):
+        with self._lock:
+            return {
+                "histogramBoundsMs": HISTOGRAM_BOUNDS_MS,
+                "days": json.loads(json.dumps(self.days)),
+            }
+
+    def save(self):
+        if not self.filename:
+            return
+        data = self.as_json()
+        tmp_filename = "%s.%i.tmp" % (self.filename, threading.get_ident())
+        with open(tmp_filename, "w") as fp:
+            json.dump(data, fp, indent=1, sort_keys=True)
+        os.replace(tmp_filename, self.filename)
+        self._last_save = time.time()
+
+
+def load_metrics(filename):
+    """Reads a saved metrics.json, or returns None if there isn't one"""
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as fp:
+        return json.load(fp)
+
+
+def format_metrics(data, *, days=None):
+    """Returns a table of the metrics (as returned by `Metrics.as_json()`) summed over the last `days` days"""
+    day_names = sorted(data.get("days", {}))
+    if days:
+        day_names = day_names[-days:]
+    totals = {}
+    for day in day_names:
+        for name, stats in data["days"][day].items():
+            add_stats(totals.setdefault(name, new_stats()), stats)
+    if not totals:
+        return "No metrics"
+    lines = []
+    if day_names:
+        lines.append("%s to %s" % (day_names[0], day_names[-1]))
+    lines.append("%-22s %8s %7s %10s %9s %8s %8s %10s %9s %9s" % (
+        "handler", "count", "errors", "total", "mean", "p50", "p99", "max", "db", "in/out"))
+    for name, stats in sorted(totals.items(), key=lambda item: -item[1]["time"]):
+        if not stats["count"]:
+            continue
+        lines.append("%-22s %8i %7i %9.1fs %7.1fms %8s %8s %8.0fms %8.0f%% %s" % (
+            name, stats["count"], stats["errors"], stats["time"], stats["time"] / stats["count"] * 1000,
+            _format_bound(histogram_percentile(stats["histogram"], 0.5)),
+            _format_bound(histogram_percentile(stats["histogram"], 0.99)),
+            stats["maxTime"] * 1000,
+            stats["dbTime"] / stats["time"] * 100 if stats["time"] else 0,
+            "%s/%s" % (_format_bytes(stats["bytesIn"]), _format_bytes(stats["bytesOut"]))))
+    return "\n".join(lines)
+
+
+def _format_bound(bound):
+    if bound is None:
+        return ">%ims" % HISTOGRAM_BOUNDS_MS[-1]
+    return "<=%ims" % bound
+
+
+def _format_bytes(size):
+    for unit in ["b", "Kb", "Mb"]:
+        if size < 1000:
+            return "%i%s" % (size, unit)
+        size /= 1000
+    return "%iGb" % size
@@ -0,0 +1,331 @@
+"""
+Versioned schema migrations for the archive database
+
+The `schema_version` table records how many of the migrations in `MIGRATIONS` have been applied.
+Each migration is a function that takes a cursor; add new ones to the end with `@migration`,
+and never change or reorder one that has been released.
+
+Each migration runs in its own transaction (`BEGIN IMMEDIATE`), together with the insert of its
+`schema_version` row, so a migration that fails or is interrupted leaves no trace, and two processes
+opening an old archive at the same time don't both apply it. So migrations must not commit: use
+`_execute_script()` instead of `executescript()`, which commits first.
+"""
+import os
+import sqlite3
+
+with open(os.path.abspath(os.path.join(__file__, "../schema.sql"))) as fp:
+    schema_sql = fp.read()
+
+MIGRATIONS = []
+
+
+def migration(func):
+    MIGRATIONS.append(func)
+    return func
+
+
+@migration
+def create_base_schema(c):
+    # This uses CREATE TABLE IF NOT EXISTS, so it is also safe for archives created before schema_version existed
+    _execute_script(c, schema_sql)
+
+
+@migration
+def add_indexes(c):
+    _execute_script(c, """
+        CREATE INDEX IF NOT EXISTS activity_url ON activity (url);
+        CREATE INDEX IF NOT EXISTS activity_sourceId ON activity (sourceId);
+        CREATE INDEX IF NOT EXISTS activity_loadTime ON activity (loadTime, id);
+        CREATE INDEX IF NOT EXISTS activity_browserVisitId ON activity (browserVisitId);
+        CREATE INDEX IF NOT EXISTS page_url ON page (url);
+        CREATE INDEX IF NOT EXISTS activity_link_activity_id ON activity_link (activity_id, url);
+    """)
+
+
+@migration
+def add_stats(c):
+    # Counters for Archive.update_status(), kept up to date by triggers so opening an archive
+    # doesn't have to count everything. The connection needs PRAGMA recursive_triggers = ON so that
+    # rows deleted by INSERT OR REPLACE are counted.
+    _execute_script(c, """
+        CREATE TABLE IF NOT EXISTS archive_stats (
+          id INTEGER PRIMARY KEY CHECK (id = 1),
+          activity_count INT NOT NULL DEFAULT 0,
+          activity_url_count INT NOT NULL DEFAULT 0,
+          fetched_count INT NOT NULL DEFAULT 0,
+          error_count INT NOT NULL DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS activity_url_stats (
+          url TEXT PRIMARY KEY,
+          activities INT NOT NULL
+        ) WITHOUT ROWID;
+
+        CREATE TRIGGER IF NOT EXISTS activity_stats_insert AFTER INSERT ON activity
+        BEGIN
+          INSERT INTO activity_url_stats (url, activities) VALUES (NEW.url, 1)
+            ON CONFLICT (url) DO UPDATE SET activities = activities + 1;
+          UPDATE archive_stats SET
+            activity_count = activity_count + 1,
+            activity_url_count = activity_url_count + (SELECT activities = 1 FROM activity_url_stats WHERE url = NEW.url);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS activity_stats_delete AFTER DELETE ON activity
+        BEGIN
+          UPDATE activity_url_stats SET activities = activities - 1 WHERE url = OLD.url;
+          UPDATE archive_stats SET
+            activity_count = activity_count - 1,
+            activity_url_count = activity_url_count - (SELECT activities = 0 FROM activity_url_stats WHERE url = OLD.url);
+          DELETE FROM activity_url_stats WHERE url = OLD.url AND activities = 0;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS activity_stats_update AFTER UPDATE OF url ON activity
+          WHEN OLD.url != NEW.url
+        BEGIN
+          UPDATE activity_url_stats SET activities = activities - 1 WHERE url = OLD.url;
+          UPDATE archive_stats SET
+            activity_url_count = activity_url_count - (SELECT activities = 0 FROM activity_url_stats WHERE url = OLD.url);
+          DELETE FROM activity_url_stats WHERE url = OLD.url AND activities = 0;
+          INSERT INTO activity_url_stats (url, activities) VALUES (NEW.url, 1)
+            ON CONFLICT (url) DO UPDATE SET activities = activities + 1;
+          UPDATE archive_stats SET
+            activity_url_count = activity_url_count + (SELECT activities = 1 FROM activity_url_stats WHERE url = NEW.url);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS page_stats_insert AFTER INSERT ON page
+        BEGIN
+          UPDATE archive_stats SET fetched_count = fetched_count + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS page_stats_delete AFTER DELETE ON page
+        BEGIN
+          UPDATE archive_stats SET fetched_count = fetched_count - 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS fetch_error_stats_insert AFTER INSERT ON fetch_error
+        BEGIN
+          UPDATE archive_stats SET error_count = error_count + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS fetch_error_stats_delete AFTER DELETE ON fetch_error
+        BEGIN
+          UPDATE archive_stats SET error_count = error_count - 1;
+        END;
+    """)
+    recount_stats(c)
+
+
+@migration
+def add_fetch_queue(c):
+    # The URLs that still need to be fetched, maintained by the saver. get_needed_pages() reads
+    # them in order from fetch_queue_next. priority goes down by one for each failed attempt, and
+    # nextAttempt (a timestamp in milliseconds) backs off exponentially.
+    _execute_script(c, """
+        CREATE TABLE IF NOT EXISTS fetch_queue (
+          url TEXT PRIMARY KEY,
+          priority INT NOT NULL DEFAULT 0,
+          lastVisitTime INT,
+          attempts INT NOT NULL DEFAULT 0,
+          nextAttempt INT NOT NULL DEFAULT 0,
+          lastError TEXT
+        ) WITHOUT ROWID;
+
+        CREATE INDEX IF NOT EXISTS fetch_queue_next
+          ON fetch_queue (priority DESC, lastVisitTime DESC, nextAttempt, lastError);
+    """)
+    c.execute("""
+        INSERT OR IGNORE INTO fetch_queue (url, priority, lastVisitTime, attempts, lastError)
+        SELECT
+            activity.url,
+            -(fetch_error.url IS NOT NULL),
+            MAX(activity.loadTime),
+            fetch_error.url IS NOT NULL,
+            fetch_error.errorMessage
+        FROM activity
+        LEFT JOIN fetch_error
+            ON fetch_error.url = activity.url
+        WHERE NOT EXISTS (SELECT 1 FROM page WHERE page.url = activity.url)
+        GROUP BY activity.url
+    """)
+
+
+@migration
+def add_change_log(c):
+    # archive_stats.change_seq goes up by one for every insert, update, or delete of an activity or
+    # page row, and change_log has the last change_seq of each activity id and page URL (including
+    # deleted ones). ActivityPool.load() uses these to re-read only what changed since a snapshot.
+    # ADD COLUMN has no IF NOT EXISTS, and archives migrated before migrations were transactional
+    # can have the column without the schema_version row:
+    if not _has_column(c, "archive_stats", "change_seq"):
+        c.execute("ALTER TABLE archive_stats ADD COLUMN change_seq INT NOT NULL DEFAULT 0")
+    _execute_script(c, """
+        CREATE TABLE IF NOT EXISTS change_log (
+          key TEXT PRIMARY KEY, -- "activity:<id>" or "page:<url>"
+          seq INT NOT NULL
+        ) WITHOUT ROWID;
+
+        CREATE INDEX IF NOT EXISTS change_log_seq ON change_log (seq);
+    """)
+    _execute_script(c, """
+        CREATE TRIGGER IF NOT EXISTS activity_change_insert AFTER INSERT ON activity
+        BEGIN
+          UPDATE archive_stats SET change_seq = change_seq + 1;
+          INSERT INTO change_log (key, seq) VALUES ('activity:' || NEW.id, (SELECT change_seq FROM archive_stats))
+            ON CONFLICT (key) DO UPDATE SET seq = excluded.seq;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS activity_change_update AFTER UPDATE ON activity
+        BEGIN
+          UPDATE archive_stats SET change_seq = change_seq + 1;
+          INSERT INTO change_log (key, seq) VALUES ('activity:' || OLD.id, (SELECT change_seq FROM archive_stats))
+            ON CONFLICT (key) DO UPDATE SET seq = excluded.seq;
+          INSERT INTO change_log (key, seq) VALUES ('activity:' || NEW.id, (SELECT change_seq FROM archive_stats))
+            ON CONFLICT (key) DO UPDATE SET seq = excluded.seq;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS activity_change_delete AFTER DELETE ON activity
+        BEGIN
+          UPDATE archive_stats SET change_seq = change_seq + 1;
+          INSERT INTO change_log (key, seq) VALUES ('activity:' || OLD.id, (SELECT change_seq FROM archive_stats))
+            ON CONFLICT (key) DO UPDATE SET seq = excluded.seq;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS page_change_insert AFTER INSERT ON page
+        BEGIN
+          UPDATE archive_stats SET change_seq = change_seq + 1;
+          INSERT INTO change_log (key, seq) VALUES ('page:' || NEW.url, (SELECT change_seq FROM archive_stats))
+            ON CONFLICT (key) DO UPDATE SET seq = excluded.seq;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS page_change_update AFTER UPDATE ON page
+        BEGIN
+          UPDATE archive_stats SET change_seq = change_seq + 1;
+          INSERT INTO change_log (key, seq) VALUES ('page:' || OLD.url, (SELECT change_seq FROM archive_stats))
+            ON CONFLICT (key) DO UPDATE SET seq = excluded.seq;
+          INSERT INTO change_log (key, seq) VALUES ('page:' || NEW.url, (SELECT change_seq FROM archive_stats))
+            ON CONFLICT (key) DO UPDATE SET seq = excluded.seq;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS page_change_delete AFTER DELETE ON page
+        BEGIN
+          UPDATE archive_stats SET change_seq = change_seq + 1;
+          INSERT INTO change_log (key, seq) VALUES ('page:' || OLD.url, (SELECT change_seq FROM archive_stats))
+            ON CONFLICT (key) DO UPDATE SET seq = excluded.seq;
+        END;
+    """)
+
+
+@migration
+def drop_stats_triggers(c):
+    # The add_stats and add_change_log triggers made several extra writes for every activity row;
+    # the code that writes activity, page, and fetch_error now does the same bookkeeping itself,
+    # once per transaction (see pha.changes). change_log gets one row each time, with a JSON list
+    # of the "activity:<id>" and "page:<url>" keys that changed. change_log_start is the
+    # change_seq that change_log starts at: a snapshot from before it can't be brought up to date.
+    for name in [
+            "activity_stats_insert", "activity_stats_delete", "activity_stats_update",
+            "page_stats_insert", "page_stats_delete", "fetch_error_stats_insert", "fetch_error_stats_delete",
+            "activity_change_insert", "activity_change_update", "activity_change_delete",
+            "page_change_insert", "page_change_update", "page_change_delete"]:
+        c.execute("DROP TRIGGER IF EXISTS %s" % name)
+    if not _has_column(c, "archive_stats", "change_log_start"):
+        c.execute("ALTER TABLE archive_stats ADD COLUMN change_log_start INT NOT NULL DEFAULT 0")
+    _execute_script(c, """
+        DROP TABLE IF EXISTS change_log;
+
+        CREATE TABLE change_log (
+          seq INTEGER PRIMARY KEY, -- archive_stats.change_seq
+          keys TEXT NOT NULL
+        );
+
+        UPDATE archive_stats SET change_log_start = change_seq;
+    """)
+
+
+def _execute_script(c, script):
+    """Executes each statement of the script, without committing (unlike `executescript()`)"""
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            c.execute(statement)
+            statement = ""
+    if statement.strip():
+        raise ValueError("Incomplete SQL statement: %r" % statement)
+
+
+def _has_column(c, table, column):
+    c.execute("PRAGMA table_info(%s)" % table)
+    return any(row[1] == column for row in c.fetchall())
+
+
+def recount_stats(c):
+    """Recomputes the archive_stats counters from scratch (this scans every table)"""
+    c.execute("DELETE FROM activity_url_stats")
+    c.execute("""
+        INSERT INTO activity_url_stats (url, activities)
+        SELECT url, COUNT(*) FROM activity GROUP BY url
+    """)
+    # An upsert, so other archive_stats columns (like change_seq) are kept:
+    c.execute("""
+        INSERT INTO archive_stats (id, activity_count, activity_url_count, fetched_count, error_count)
+        SELECT
+            1,
+            (SELECT COUNT(*) FROM activity),
+            (SELECT COUNT(*) FROM activity_url_stats),
+            (SELECT COUNT(*) FROM page),
+            (SELECT COUNT(*) FROM fetch_error)
+        WHERE true
+        ON CONFLICT (id) DO UPDATE SET
+          activity_count = excluded.activity_count,
+          activity_url_count = excluded.activity_url_count,
+          fetched_count = excluded.fetched_count,
+          error_count = excluded.error_count
+    """)
+
+
+def schema_version(conn):
+    c = conn.cursor()
+    try:
+        c.execute("SELECT MAX(version) FROM schema_version")
+    except sqlite3.OperationalError:
+        # An archive from before migrations existed, or a new archive
+        return 0
+    return c.fetchone()[0] or 0
+
+
+def migrate(conn, target=None):
+    """Applies any migrations that haven't been applied yet, up to version `target` (default: all)
+
+    Returns the list of versions that were applied
+    """
+    if target is None:
+        target = len(MIGRATIONS)
+    applied = []
+    if schema_version(conn) >= target:
+        return applied
+    if conn.in_transaction:
+        conn.commit()
+    while True:
+        # Another process may have migrated the archive since the version was read, so it's read
+        # again once this connection has the write lock:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            c = conn.cursor()
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                  version INT NOT NULL
+                )
+            """)
+            version = schema_version(conn)
+            if version >= target:
+                conn.rollback()
+                return applied
+            MIGRATIONS[version](c)
+            version += 1
+            c.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        applied.append(version)
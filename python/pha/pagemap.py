@@ -0,0 +1,68 @@
+"""
+Runs a function over many archived pages, in worker processes
+
+`Archive.map_pages()` uses this. The parent sends batches of URLs to a `multiprocessing.Pool`; each
+worker opens the archive itself (read-only), builds each `Page`, and calls the function on it. Only
+URLs go to the workers and only the function's results come back, so `Page` objects (and their
+parsed documents) are never pickled.
+
+The function and its results must be picklable: a function defined at the top level of a module
+works, and in a notebook so does one defined in the notebook (workers are forked, where that's
+available). A lambda or nested function does not.
+
+URLs whose page data is missing (a `page` row without its file or blob) are skipped.
+"""
+import os
+
+# The worker's read-only Archive, and the function to call, set by _init_worker():
+_worker_archive = None
+_worker_fn = None
+
+
+def map_pages(archive, fn, urls=None, *, processes=None, chunksize=50, ordered=True):
+    """Yields `(url, fn(page))` for each URL (default: every fetched page), see `Archive.map_pages()`"""
+    if urls is None:
+        c = archive.read_conn.cursor()
+        # A page fetched more than once has several rows:
+        c.execute("SELECT DISTINCT url FROM page ORDER BY url")
+        urls = [row[0] for row in c]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes <= 1:
+        # Everything in this process, which is easier to debug:
+        from . import Page
+        for url in urls:
+            if archive.has_page_file(url):
+                yield url, fn(Page(archive, url))
+        return
+    # Only imported when it's used, to keep `import pha` fast for the saver:
+    import multiprocessing
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(archive.path, fn)) as pool:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for results in imap(_map_chunk, _chunks(urls, chunksize)):
+            yield from results
+
+
+def _chunks(urls, size):
+    chunk = []
+    for url in urls:
+        chunk.append(url)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _init_worker(path, fn):
+    global _worker_archive, _worker_fn
+    from . import Archive
+    _worker_archive = Archive(path, readonly=True)
+    _worker_fn = fn
+
+
+def _map_chunk(urls):
+    from . import Page
+    return [
+        (url, _worker_fn(Page(_worker_archive, url)))
+        for url in urls if _worker_archive.has_page_file(url)]
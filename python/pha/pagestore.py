@@ -0,0 +1,647 @@
+"""
+Reading and writing the JSON data of fetched pages
+
+Pages are stored in one of these ways:
+
+* As files, `pages/<quoted-url>-page.json`. This is the original (legacy) layout.
+* As compressed files, `pages/<quoted-url>-page.json.zst`, compressed with
+  [zstd](https://facebook.github.io/zstd/) using a dictionary trained on a sample of the archive's own pages
+  (the pages are all similar, so this compresses *much* better than compressing each file on its own).
+  Compression requires the `zstandard` package.
+* In either of those file formats, in hash-sharded subdirectories: `pages/ab/cd/<quoted-url>-page.json`
+  (where `abcd` is the start of the SHA1 of the base filename). This is layout version 2, and is recorded in
+  `pages/LAYOUT`. It keeps directories small enough that the filesystem stays fast.
+* In pack files: page blobs are appended to large segment files in `packs/`, and the `page_blob` table
+  keeps the segment, offset, and length of each URL's blob. Blobs are read through `mmap`.
+
+All of these are read transparently. Once an archive has a `packs/` directory new pages are written
+into packs, otherwise they are written as files (compressed if the archive has a dictionary).
+
+Use `python -m pha compress-pages` to compress existing page files, `python -m pha shard-pages` to move
+them into sharded directories, `python -m pha pack-pages` to move them into packs, and `python -m pha compact-packs` to reclaim the space of pages that have been replaced.
+"""
+import os
+import json
+import mmap
+import random
+import hashlib
+import threading
+from urllib.parse import unquote as url_unquote
+
+COMPRESSED_SUFFIX = ".zst"
+PACK_SEGMENT_SIZE = 1 << 30
+# pack_pages() and compact_packs() append and commit this many pages (or bytes) at a time:
+PACK_BATCH_PAGES = 1000
+PACK_BATCH_BYTES = 64 << 20
+# Held while appending to a segment, so blobs from different threads don't interleave:
+_segment_lock = threading.Lock()
+
+LAYOUT_FLAT = 1
+LAYOUT_SHARDED = 2
+PAGE_SUFFIXES = ("-page.json", "-page.json" + COMPRESSED_SUFFIX)
+# The URL page_file_url() gives for a file whose name was shortened with a hash:
+TRUNCATED = object()
+# While this file exists, pages are being moved from the flat layout to the sharded layout:
+MIGRATING_FILENAME = "LAYOUT-MIGRATING"
+
+zstandard = None
+
+
+def _import_zstandard():
+    global zstandard
+    if zstandard is None:
+        import zstandard
+    return zstandard
+
+
+def dictionary_path(archive):
+    return os.path.join(archive.path, "page-dictionaries")
+
+
+def current_dictionary_id(archive):
+    """The id of the dictionary new pages are compressed with, or None if pages aren't compressed"""
+    filename = os.path.join(dictionary_path(archive), "current")
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as fp:
+        return int(fp.read().strip())
+
+
+def load_dictionary(archive, dict_id):
+    if dict_id not in archive._page_dictionaries:
+        _import_zstandard()
+        with open(os.path.join(dictionary_path(archive), "%s.dict" % dict_id), "rb") as fp:
+            archive._page_dictionaries[dict_id] = zstandard.ZstdCompressionDict(fp.read())
+    return archive._page_dictionaries[dict_id]
+
+
+def compress(archive, data, *, level=3):
+    """Compresses the page JSON (bytes) using the archive's current dictionary"""
+    _import_zstandard()
+    dictionary = load_dictionary(archive, current_dictionary_id(archive))
+    return zstandard.ZstdCompressor(level=level, dict_data=dictionary).compress(data)
+
+
+def decompress(archive, data):
+    _import_zstandard()
+    dict_id = zstandard.get_frame_parameters(data).dict_id
+    if dict_id:
+        decompressor = zstandard.ZstdDecompressor(dict_data=load_dictionary(archive, dict_id))
+    else:
+        decompressor = zstandard.ZstdDecompressor()
+    return decompressor.decompress(data)
+
+
+def should_compress(archive):
+    return current_dictionary_id(archive) is not None and _zstandard_available()
+
+
+def read_page(archive, url):
+    """Returns the page data for the URL, from a pack or from the compressed or plain JSON file"""
+    data, compressed = read_raw_page(archive, url)
+    if compressed:
+        data = decompress(archive, data)
+    return json.loads(data.decode("UTF-8"))
+
+
+def read_raw_page(archive, url):
+    """Returns `(content, compressed)` for the URL, without decoding or decompressing it"""
+    from . import Page
+    c = archive.read_conn.cursor()
+    c.execute("""
+        SELECT segment, offset, length, compressed FROM page_blob WHERE url = ?
+    """, (url,))
+    row = c.fetchone()
+    if row:
+        return read_blob(archive, row["segment"], row["offset"], row["length"]), bool(row["compressed"])
+    filename = Page.json_filename(archive, url)
+    if archive.page_layout_migrating:
+        try:
+            return read_raw_page_file(filename)
+        except FileNotFoundError:
+            filename = os.path.join(archive.pages_path, Page.generate_base_filename(url) + "-page.json")
+    return read_raw_page_file(filename)
+
+
+def write_page(archive, url, data):
+    """Writes the page data, into a pack if the archive has packs, otherwise into a file
+
+    The data is compressed if the archive has a dictionary (and zstandard is installed)
+    """
+    pages = [(url,) + encode_page(archive, data)]
+    if packs_enabled(archive):
+        with archive.lock:
+            index_pages(archive, pages, store_pages(archive, pages))
+            archive.conn.commit()
+    else:
+        store_pages(archive, pages)
+    # In a batch the commit above waits for the batch, and so must removing the old copies:
+    archive.conn.after_commit(lambda: pages_stored(archive, pages))
+
+
+def encode_page(archive, data):
+    """Returns `(content, compressed)`, the bytes to store for the page data"""
+    content = json.dumps(data).encode("UTF-8")
+    compressed = should_compress(archive)
+    if compressed:
+        content = compress(archive, content)
+    return content, compressed
+
+
+def store_pages(archive, pages, *, sync=False):
+    """Writes the encoded `pages`, a list of `(url, content, compressed)`, without touching the database
+
+    Returns the locations to pass to `index_pages()`. With `sync` the data is on disk (fsynced) when
+    this returns; blobs appended to packs are always synced.
+    """
+    from . import Page
+    if packs_enabled(archive):
+        return _append_to_segment(archive, [content for url, content, compressed in pages])
+    # Another process may have started shard_pages() since the layout was read:
+    refresh_layout(archive)
+    layout = archive.page_layout
+    dirnames = set()
+    written = []
+    for url, content, compressed in pages:
+        filename = Page.json_filename(archive, url)
+        if compressed:
+            filename += COMPRESSED_SUFFIX
+        _write_file(filename, content, sync=sync)
+        dirnames.add(os.path.dirname(filename))
+        written.append((url, compressed, filename))
+    refresh_layout(archive)
+    if archive.page_layout != layout:
+        # The layout was switched while these were written, maybe after shard_pages() listed the
+        # files to move; these are the newest copies, so they replace anything already there
+        for url, compressed, filename in written:
+            dest = Page.json_filename(archive, url) + (COMPRESSED_SUFFIX if compressed else "")
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            try:
+                os.replace(filename, dest)
+            except FileNotFoundError:
+                # shard_pages() moved it
+                pass
+            dirnames.add(os.path.dirname(dest))
+    if sync:
+        for dirname in dirnames:
+            _sync_directory(dirname)
+    return None
+
+
+def index_pages(archive, pages, locations):
+    """Records pages written by `store_pages()` in page_blob, if they are in packs (the caller commits)"""
+    if locations is not None:
+        _index_blobs(archive, pages, locations)
+
+
+def pages_stored(archive, pages):
+    """Removes older copies of the pages and updates the archive's index, once the pages are committed"""
+    from . import Page
+    packed = packs_enabled(archive)
+    for url, content, compressed in pages:
+        filename = Page.json_filename(archive, url)
+        if packed:
+            _remove_if_exists(filename)
+            _remove_if_exists(filename + COMPRESSED_SUFFIX)
+            archive.page_packed(url)
+        elif compressed:
+            _remove_if_exists(filename)
+            archive.page_file_added(filename + COMPRESSED_SUFFIX)
+        else:
+            _remove_if_exists(filename + COMPRESSED_SUFFIX)
+            archive.page_file_added(filename)
+
+
+def _zstandard_available():
+    try:
+        _import_zstandard()
+    except ImportError:
+        return False
+    return True
+
+
+def _write_file(filename, content, *, sync=False):
+    dirname = os.path.dirname(filename)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    # Unique per thread, as the saver may write pages from several threads:
+    tmp_filename = "%s.%i.tmp" % (filename, threading.get_ident())
+    with open(tmp_filename, "wb") as fp:
+        fp.write(content)
+        if sync:
+            fp.flush()
+            os.fsync(fp.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def _sync_directory(dirname):
+    """Makes renames in the directory durable"""
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _remove_if_exists(filename):
+    try:
+        os.unlink(filename)
+    except FileNotFoundError:
+        pass
+
+
+def train_dictionary(archive, *, sample_size=1000, dict_size=112640):
+    """Trains a new dictionary from a random sample of the archive's pages, and makes it current
+
+    Returns the new dictionary's id
+    """
+    _import_zstandard()
+    c = archive.read_conn.cursor()
+    c.execute("SELECT url FROM page")
+    urls = [row[0] for row in c if archive.has_page_file(row[0])]
+    if not urls:
+        raise Exception("No pages in %s to train a dictionary with" % archive.path)
+    samples = []
+    for url in random.sample(urls, min(sample_size, len(urls))):
+        data, compressed = read_raw_page(archive, url)
+        if compressed:
+            data = decompress(archive, data)
+        samples.append(data)
+    dictionary = zstandard.train_dictionary(dict_size, samples)
+    dict_id = dictionary.dict_id()
+    path = dictionary_path(archive)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    _write_file(os.path.join(path, "%s.dict" % dict_id), dictionary.as_bytes())
+    _write_file(os.path.join(path, "current"), str(dict_id).encode("ascii"))
+    return dict_id
+
+
+def compress_pages(archive, *, level=3, retrain=False, sample_size=1000, verbose=False):
+    """Converts all the plain JSON page files in the archive to compressed files, in place
+
+    This can be interrupted and run again; files that are already compressed are skipped.
+    Returns the number of files converted.
+    """
+    if retrain or current_dictionary_id(archive) is None:
+        dict_id = train_dictionary(archive, sample_size=sample_size)
+        if verbose:
+            print("Trained dictionary", dict_id)
+    names = sorted(name for name in archive.page_files if name.endswith("-page.json"))
+    count = 0
+    before = after = 0
+    for name in names:
+        filename = os.path.join(archive.pages_path, name)
+        with open(filename, "rb") as fp:
+            content = fp.read()
+        compressed = compress(archive, content, level=level)
+        _write_file(filename + COMPRESSED_SUFFIX, compressed)
+        os.unlink(filename)
+        count += 1
+        before += len(content)
+        after += len(compressed)
+        if verbose and not count % 1000:
+            print("Compressed %i/%i pages" % (count, len(names)))
+    archive.refresh_page_files()
+    if verbose and count:
+        print("Compressed %i pages: %iMb -> %iMb" % (count, before / 1000000, after / 1000000))
+    return count
+
+
+def packs_enabled(archive):
+    return os.path.isdir(archive.packs_path)
+
+
+def segment_filename(archive, segment):
+    return os.path.join(archive.packs_path, "%06i.pack" % segment)
+
+
+def list_segments(archive):
+    if not packs_enabled(archive):
+        return []
+    return sorted(int(name[:-len(".pack")]) for name in os.listdir(archive.packs_path) if name.endswith(".pack"))
+
+
+def _active_segment(archive):
+    segments = list_segments(archive)
+    if not segments:
+        return 1
+    if os.path.getsize(segment_filename(archive, segments[-1])) >= PACK_SEGMENT_SIZE:
+        return segments[-1] + 1
+    return segments[-1]
+
+
+def append_blob(archive, url, content, compressed):
+    """Appends the blob to the active segment, and records it in page_blob (the caller commits)
+
+    The blob is synced to disk before the page_blob row is written, so the index never points at
+    data that isn't there. Any previous blob for the URL becomes garbage for `compact_packs()`.
+    """
+    pages = [(url, content, compressed)]
+    _index_blobs(archive, pages, _append_to_segment(archive, [content]))
+
+
+def _append_to_segment(archive, contents):
+    """Appends the blobs to the active segment and syncs it, returning `[(segment, offset), ...]`"""
+    with _segment_lock:
+        segment = _active_segment(archive)
+        locations = []
+        with open(segment_filename(archive, segment), "ab") as fp:
+            offset = fp.tell()
+            for content in contents:
+                fp.write(content)
+                locations.append((segment, offset))
+                offset += len(content)
+            fp.flush()
+            os.fsync(fp.fileno())
+    return locations
+
+
+def _index_blobs(archive, pages, locations):
+    c = archive.conn.cursor()
+    c.executemany("""
+        INSERT OR REPLACE INTO page_blob (url, segment, offset, length, compressed)
+        VALUES (?, ?, ?, ?, ?)
+    """, [
+        (url, segment, offset, len(content), compressed)
+        for (url, content, compressed), (segment, offset) in zip(pages, locations)])
+
+
+def _pack_batch(archive, batch):
+    """Appends a batch of pages to the active segment (with one fsync), and indexes and commits them
+
+    `batch` is a list of `((url, content, compressed), previous)`, where `previous` is the
+    `(segment, offset)` the URL's page_blob row had when the content was read, or None if it had
+    none. The row is only written if it is still the same, so a page the saver wrote in the
+    meantime keeps its newer blob. Returns the URLs that were indexed.
+    """
+    if not batch:
+        return []
+    locations = _append_to_segment(archive, [content for (url, content, compressed), previous in batch])
+    indexed = []
+    with archive.lock:
+        c = archive.conn.cursor()
+        for ((url, content, compressed), previous), (segment, offset) in zip(batch, locations):
+            if previous is None:
+                c.execute("""
+                    INSERT INTO page_blob (url, segment, offset, length, compressed)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (url) DO NOTHING
+                """, (url, segment, offset, len(content), compressed))
+            else:
+                c.execute("""
+                    UPDATE page_blob SET segment = ?, offset = ?, length = ?, compressed = ?
+                    WHERE url = ? AND segment = ? AND offset = ?
+                """, (segment, offset, len(content), compressed, url) + tuple(previous))
+            if c.rowcount:
+                indexed.append(url)
+        archive.conn.commit()
+    return indexed
+
+
+def read_blob(archive, segment, offset, length):
+    m = archive._pack_maps.get(segment)
+    if m is None or offset + length > len(m):
+        # The segment has grown since we mapped it (or hasn't been mapped yet)
+        if m is not None:
+            m.close()
+        with open(segment_filename(archive, segment), "rb") as fp:
+            m = archive._pack_maps[segment] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    return m[offset:offset + length]
+
+
+def _close_segment(archive, segment):
+    m = archive._pack_maps.pop(segment, None)
+    if m is not None:
+        m.close()
+
+
+def pack_pages(archive, *, verbose=False):
+    """Moves all the page files (plain or compressed) of the archive into packs
+
+    This turns packs on for the archive. It can be interrupted and run again.
+    Returns the number of pages moved.
+    """
+    from . import Page
+    if not packs_enabled(archive):
+        os.makedirs(archive.packs_path)
+    c = archive.read_conn.cursor()
+    c.execute("SELECT DISTINCT url FROM page")
+    urls = [row[0] for row in c]
+    count = 0
+    batch = []
+    batch_bytes = 0
+    for url in urls:
+        if url in archive.packed_urls or not archive.has_page_file(url):
+            continue
+        content, compressed = read_raw_page(archive, url)
+        batch.append(((url, content, compressed), None))
+        batch_bytes += len(content)
+        if len(batch) >= PACK_BATCH_PAGES or batch_bytes >= PACK_BATCH_BYTES:
+            count += _pack_urls(archive, batch)
+            batch = []
+            batch_bytes = 0
+            if verbose:
+                print("Packed %i pages" % count)
+    count += _pack_urls(archive, batch)
+    # Only remove files once their blobs are committed:
+    for url in urls:
+        if url in archive.packed_urls:
+            filename = Page.json_filename(archive, url)
+            _remove_if_exists(filename)
+            _remove_if_exists(filename + COMPRESSED_SUFFIX)
+    archive.refresh_page_files()
+    if verbose:
+        print("Packed %i pages into %i segments" % (count, len(list_segments(archive))))
+    return count
+
+
+def _pack_urls(archive, batch):
+    indexed = _pack_batch(archive, batch)
+    for url in indexed:
+        archive.page_packed(url)
+    return len(indexed)
+
+
+def read_raw_page_file(filename):
+    try:
+        with open(filename + COMPRESSED_SUFFIX, "rb") as fp:
+            return fp.read(), True
+    except FileNotFoundError:
+        with open(filename, "rb") as fp:
+            return fp.read(), False
+
+
+def compact_packs(archive, *, min_garbage=0.25, verbose=False):
+    """Rewrites segments where at least `min_garbage` of the space belongs to replaced pages
+
+    Live blobs are copied into the active segment (which is never itself compacted), and the old
+    segment is deleted. A page the saver writes again while this runs keeps its new blob. Returns
+    the number of bytes reclaimed.
+    """
+    segments = list_segments(archive)
+    c = archive.read_conn.cursor()
+    reclaimed = 0
+    for segment in segments[:-1]:
+        size = os.path.getsize(segment_filename(archive, segment))
+        c.execute("""
+            SELECT url, offset, length, compressed FROM page_blob WHERE segment = ? ORDER BY offset
+        """, (segment,))
+        rows = c.fetchall()
+        live = sum(row["length"] for row in rows)
+        if size and live / size > 1 - min_garbage:
+            continue
+        batch = []
+        batch_bytes = 0
+        for row in rows:
+            content = read_blob(archive, segment, row["offset"], row["length"])
+            batch.append(((row["url"], content, row["compressed"]), (segment, row["offset"])))
+            batch_bytes += len(content)
+            if len(batch) >= PACK_BATCH_PAGES or batch_bytes >= PACK_BATCH_BYTES:
+                _pack_batch(archive, batch)
+                batch = []
+                batch_bytes = 0
+        _pack_batch(archive, batch)
+        _close_segment(archive, segment)
+        os.unlink(segment_filename(archive, segment))
+        reclaimed += size - live
+        if verbose:
+            print("Compacted segment %i: %i pages, reclaimed %iMb" % (segment, len(rows), (size - live) / 1000000))
+    return reclaimed
+
+
+def refresh_layout(archive):
+    """Reads the archive's layout again, unless it's sharded already (which never changes)"""
+    if archive.page_layout == LAYOUT_SHARDED and not archive.page_layout_migrating:
+        return
+    archive.page_layout, archive.page_layout_migrating = read_layout(archive)
+
+
+def read_annotations(archive, url):
+    """Returns the annotations saved for the page, or `{}`"""
+    from . import Page
+    filenames = [Page.annotation_filename(archive, url)]
+    if archive.page_layout_migrating:
+        # Like read_raw_page(), falls back to the flat layout:
+        filenames.append(os.path.join(archive.pages_path, Page.generate_base_filename(url) + "-annotation.json"))
+    for filename in filenames:
+        try:
+            with open(filename) as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            pass
+    return {}
+
+
+def read_layout(archive):
+    """Returns `(layout_version, migrating)` for the archive's `pages/` directory"""
+    filename = os.path.join(archive.pages_path, "LAYOUT")
+    if not os.path.exists(filename):
+        return LAYOUT_FLAT, False
+    with open(filename) as fp:
+        version = int(fp.read().strip())
+    return version, os.path.exists(os.path.join(archive.pages_path, MIGRATING_FILENAME))
+
+
+def shard_path(base_filename):
+    """The location (relative to `pages/`) of files with this base filename in the sharded layout"""
+    digest = hashlib.sha1(base_filename.encode("UTF-8")).hexdigest()
+    return os.path.join(digest[:2], digest[2:4], base_filename)
+
+
+def scan_page_files(archive):
+    """Returns the set of page file names, relative to `pages/`"""
+    names = set()
+    with os.scandir(archive.pages_path) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                names.add(entry.name)
+                continue
+            with os.scandir(entry.path) as sub_entries:
+                for sub_entry in sub_entries:
+                    prefix = os.path.join(entry.name, sub_entry.name)
+                    with os.scandir(sub_entry.path) as files:
+                        names.update(os.path.join(prefix, f.name) for f in files)
+    return names
+
+
+def page_file_url(name):
+    """Returns `(layout, url)` for a page file from `scan_page_files()`, or None if it isn't one
+
+    The URL is recovered from the file's name, so this doesn't have to quote or hash anything. It is
+    TRUNCATED if the name was shortened with a hash (see `Page.generate_base_filename()`).
+    """
+    directory, base = os.path.split(name)
+    for suffix in PAGE_SUFFIXES:
+        if base.endswith(suffix):
+            base = base[:-len(suffix)]
+            url = TRUNCATED if base.endswith("-trunc") else url_unquote(base)
+            return (LAYOUT_SHARDED if directory else LAYOUT_FLAT), url
+    return None
+
+
+def _base_filename(name):
+    # Only finished files: not the temporary files writers are about to rename into place
+    for suffix in ("-page.json", "-page.json" + COMPRESSED_SUFFIX, "-annotation.json"):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return None
+
+
+def shard_pages(archive, *, threads=8, verbose=False):
+    """Moves the archive's page files from the flat layout into the sharded layout
+
+    The layout is switched first (so pages written meanwhile go to the new location), and reads fall
+    back to the old location until the migration is finished. Files are moved in parallel, and
+    the migration can be interrupted and run again. A page already written to its new location
+    isn't replaced by the old copy. Returns the number of files moved.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    version, migrating = read_layout(archive)
+    if version == LAYOUT_SHARDED and not migrating:
+        return 0
+    migrating_filename = os.path.join(archive.pages_path, MIGRATING_FILENAME)
+    with open(migrating_filename, "w"):
+        pass
+    _write_file(os.path.join(archive.pages_path, "LAYOUT"), str(LAYOUT_SHARDED).encode("ascii"))
+    archive.page_layout, archive.page_layout_migrating = LAYOUT_SHARDED, True
+
+    def move(name):
+        source = os.path.join(archive.pages_path, name)
+        dest = os.path.join(archive.pages_path, shard_path(_base_filename(name)))
+        dest = os.path.join(os.path.dirname(dest), name)
+        others = [dest]
+        if name.endswith("-page.json"):
+            others.append(dest + COMPRESSED_SUFFIX)
+        elif name.endswith(COMPRESSED_SUFFIX):
+            others.append(dest[:-len(COMPRESSED_SUFFIX)])
+        if any(os.path.exists(other) for other in others):
+            # Written since the layout was switched, so this copy is older:
+            _remove_if_exists(source)
+            return False
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            os.replace(source, dest)
+        except FileNotFoundError:
+            # A writer that still had the flat layout moved it itself
+            return False
+        return True
+
+    count = 0
+    while True:
+        # Files written by a writer that hadn't seen the new layout yet are found on the next pass:
+        with os.scandir(archive.pages_path) as entries:
+            names = [entry.name for entry in entries if entry.is_file() and _base_filename(entry.name)]
+        if not names:
+            break
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for moved in executor.map(move, names):
+                count += moved
+                if verbose and moved and not count % 10000:
+                    print("Moved %i files" % count)
+    os.unlink(migrating_filename)
+    archive.page_layout_migrating = False
+    archive.refresh_page_files()
+    if verbose:
+        print("Moved %i files into the sharded layout" % count)
+    return count
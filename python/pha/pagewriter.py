@@ -0,0 +1,168 @@
+"""
+Writes fetched pages in the background
+
+Without a PageWriter, `add_fetched_page` writes the page and its `page` row before it replies. With
+one, the handler encodes the page, puts it on a queue, and waits; the writer thread takes everything
+that is waiting and writes it as a group: first all the page data (fsynced), then all the `page` rows
+in one transaction. While a group is being written the next one collects, so when several handlers
+are writing pages at once there are few fsyncs and commits per page.
+
+The handler replies only once its group is committed, so a page the extension was told was saved
+is never lost. Because the data is synced before its row is committed, a crash never leaves a
+`page` row without its page either.
+
+The queue holds at most `max_bytes` of encoded pages. When it is full `put()` waits, which holds back
+the dispatcher.
+"""
+import sys
+import atexit
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import Future
+from . import pagestore
+from .changes import Changes
+
+
+def insert_page_rows(archive, rows):
+    """Inserts `(id, url, activityId, redirectUrl, timeToFetch)` rows into page (the caller commits)
+
+    The URLs are also taken out of fetch_error and fetch_queue, and added to the archive's
+    `fetched_url_filter`.
+    """
+    c = archive.conn.cursor()
+    changes = Changes()
+    ids = [row[0] for row in rows]
+    for i in range(0, len(ids), archive.sql_chunk_size):
+        chunk = ids[i:i + archive.sql_chunk_size]
+        c.execute("""
+            SELECT url FROM page WHERE id IN (%s)
+        """ % ", ".join("?" * len(chunk)), chunk)
+        changes.pages_removed(row[0] for row in c.fetchall())
+    c.executemany("""
+        INSERT OR REPLACE INTO page (id, url, activityId, fetched, redirectUrl, timeToFetch)
+        VALUES (?, ?, ?, CURRENT_TIMESTAMP, ?, ?)
+    """, rows)
+    changes.pages_added({row[0]: row[1] for row in rows}.values())
+    urls = [(row[1],) for row in rows]
+    c.executemany("""
+        DELETE FROM fetch_error
+        WHERE url = ?
+    """, urls)
+    changes.errors_added(-c.rowcount)
+    c.executemany("""
+        DELETE FROM fetch_queue
+        WHERE url = ?
+    """, urls)
+    changes.save(archive)
+    archive.pages_fetched(row[1] for row in rows)
+
+
+class PageWriter:
+
+    def __init__(self, archive, *, max_bytes=64 << 20, batch_bytes=16 << 20):
+        self.archive = archive
+        self.max_bytes = max_bytes
+        self.batch_bytes = batch_bytes
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._queued_bytes = 0
+        self._writing = 0
+        # The number of queued (or being written) pages for each URL:
+        self._pending = {}
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="page-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __repr__(self):
+        return '<PageWriter %s>' % self.archive.path
+
+    def put(self, row, data):
+        """Queues the page data, and its `page` row (as for `insert_page_rows()`)
+
+        Returns a `Future` that is done when both are committed (or have failed).
+        """
+        url = row[1]
+        content, compressed = pagestore.encode_page(self.archive, data)
+        with self._cond:
+            # A page bigger than max_bytes still gets through once the queue is empty:
+            while self._queued_bytes and self._queued_bytes + len(content) > self.max_bytes and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                raise Exception("PageWriter is closed")
+            future = Future()
+            self._queue.append((row, (url, content, compressed), future))
+            self._queued_bytes += len(content)
+            self._pending[url] = self._pending.get(url, 0) + 1
+            self._cond.notify_all()
+        return future
+
+    def is_pending(self, url):
+        """True if the page for this URL is queued but not yet committed"""
+        with self._cond:
+            return url in self._pending
+
+    def pending_urls(self):
+        with self._cond:
+            return set(self._pending)
+
+    def flush(self):
+        """Waits until every page queued so far has been committed"""
+        with self._cond:
+            while self._queue or self._writing:
+                self._cond.wait()
+
+    def close(self):
+        """Writes everything that is queued, and stops the writer thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                batch = []
+                size = 0
+                while self._queue and (not batch or size + len(self._queue[0][1][1]) <= self.batch_bytes):
+                    item = self._queue.popleft()
+                    batch.append(item)
+                    size += len(item[1][1])
+                self._writing = len(batch)
+            try:
+                self._write(batch)
+                error = None
+            except Exception as e:
+                # These pages have no rows, so the extension will fetch them again
+                print("Error writing %i pages:" % len(batch), file=sys.stderr)
+                traceback.print_exc(file=sys.stderr)
+                error = e
+            with self._cond:
+                for row, (url, content, compressed), future in batch:
+                    self._queued_bytes -= len(content)
+                    self._pending[url] -= 1
+                    if not self._pending[url]:
+                        del self._pending[url]
+                self._writing = 0
+                self._cond.notify_all()
+            for row, page, future in batch:
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+    def _write(self, batch):
+        archive = self.archive
+        pages = [page for row, page, future in batch]
+        locations = pagestore.store_pages(archive, pages, sync=True)
+        with archive.lock:
+            pagestore.index_pages(archive, pages, locations)
+            insert_page_rows(archive, [row for row, page, future in batch])
+            archive.conn.commit()
+        pagestore.pages_stored(archive, pages)
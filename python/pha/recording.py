@@ -0,0 +1,77 @@
+"""
+Records the native-messaging frames the saver reads and writes
+
+Set `$PHA_RECORD_MESSAGES` to a filename, and `get_message()` and `send_message()` append every frame
+to it. Each record is a direction byte (`<` for a message from the extension, `>` for a reply), the
+time as a double, and then the frame exactly as it was sent: a 4-byte native-endian length and the
+JSON. `benchmarks/bench_replay.py` can replay a recording against the saver. browsinglab's connector
+records the same way, with `$BROWSINGLAB_RECORD_MESSAGES`.
+
+Recordings include everything the extension sends, pages and history included, so treat them as
+private.
+"""
+import os
+import time
+import struct
+import atexit
+import threading
+
+INCOMING = b"<"
+OUTGOING = b">"
+
+header_struct = struct.Struct("<cd")
+length_struct = struct.Struct("@I")
+
+
+class Recorder:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._fp = open(filename, "ab")
+        atexit.register(self.close)
+
+    def __repr__(self):
+        return '<Recorder %s>' % self.filename
+
+    def record(self, direction, *chunks):
+        """Records a frame, given as one or more bytes-like chunks"""
+        with self._lock:
+            if self._fp is None:
+                return
+            self._fp.write(header_struct.pack(direction, time.time()))
+            for chunk in chunks:
+                self._fp.write(chunk)
+
+    def close(self):
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+
+def recorder_from_environment(variable="PHA_RECORD_MESSAGES"):
+    """Returns a Recorder if `$variable` names a file, otherwise None"""
+    filename = os.environ.get(variable)
+    if not filename:
+        return None
+    return Recorder(filename)
+
+
+def read_frames(filename, direction=None):
+    """Yields `(direction, time, frame)` from a recording, optionally only those in one direction
+
+    `frame` includes the length prefix, so it can be written to the saver as-is.
+    """
+    with open(filename, "rb") as fp:
+        while True:
+            header = fp.read(header_struct.size)
+            if len(header) < header_struct.size:
+                return
+            frame_direction, created = header_struct.unpack(header)
+            length = fp.read(length_struct.size)
+            if len(length) < length_struct.size:
+                return
+            data = fp.read(length_struct.unpack(length)[0])
+            if direction is None or frame_direction == direction:
+                yield frame_direction, created, length + data
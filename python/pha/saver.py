@@ -3,19 +3,41 @@ Implements saving information into the database/files
 """
 
 import os
-import re
 import stat
 import json
 import sys
-import struct
 import time
-import pprint
 import traceback
 import uuid
-from . import Page
+from . import pagestore
+from .logwriter import get_log_writer, describe_message, LEVELS, DEFAULT_LEVEL
+from .dispatcher import Dispatcher
+from .pagewriter import PageWriter, insert_page_rows
+from . import recording
+from . import frames
+from .metrics import Metrics
+from .connection import start_db_timer, stop_db_timer
+from .changes import Changes
 
 message_handlers = {}
 
+# Set by run_saver() if $PHA_RECORD_MESSAGES is set (see pha.recording):
+recorder = None
+# Every message is described on stderr only when $PHA_LOG_LEVEL is debug:
+log_messages = LEVELS[DEFAULT_LEVEL] <= LEVELS["debug"]
+# Set by run_saver() (see pha.metrics):
+metrics = None
+
+# The number of values to put in one "IN (?, ?, ...)" query:
+SQL_CHUNK_SIZE = 500
+
+# Priorities in fetch_queue: pages from browsing now are fetched before pages from imported history
+PRIORITY_HISTORY = 0
+PRIORITY_ACTIVITY = 1
+# A failed fetch is retried after RETRY_DELAY milliseconds, doubling each time, up to MAX_RETRY_DELAY:
+RETRY_DELAY = 60 * 1000
+MAX_RETRY_DELAY = 7 * 24 * 60 * 60 * 1000
+
 
 def addon(func):
     message_handlers[func.__name__] = func
@@ -28,37 +50,26 @@ def add_history_list(archive, *, browserId, sessionId, historyItems):
     for history in historyItems.values():
         for visitId, visit in history["visits"].items():
             visits_to_ids[visitId] = visit["activity_id"] = str(uuid.uuid1())
+    c = archive.conn.cursor()
+    # Visits can refer to visits we saved in an earlier message:
+    referring_visit_ids = set(
+        visit["referringVisitId"]
+        for history in historyItems.values()
+        for visit in history["visits"].values()
+        if visit.get("referringVisitId") and visit["referringVisitId"] not in visits_to_ids)
+    for visitIds in chunks(sorted(referring_visit_ids), SQL_CHUNK_SIZE):
+        c.execute("""
+            SELECT browserVisitId, id FROM activity WHERE browserVisitId IN (%s)
+        """ % ", ".join(["?"] * len(visitIds)), visitIds)
+        for row in c.fetchall():
+            visits_to_ids.setdefault(row["browserVisitId"], row["id"])
+    rows = []
     for historyId, history in historyItems.items():
-        c = archive.conn.cursor()
         for visitId, visit in history["visits"].items():
-            c.execute("""
-                DELETE FROM activity WHERE browserVisitId = ?
-            """, (visitId,))
             sourceId = None
             if visit.get("referringVisitId"):
                 sourceId = visits_to_ids.get(visit["referringVisitId"])
-                if not sourceId:
-                    c.execute("""
-                        SELECT id FROM activity WHERE browserVisitId = ?
-                    """, (visit["referringVisitId"],))
-                    row = c.fetchone()
-                    if row:
-                        sourceId = row.id
-            c.execute("""
-                INSERT INTO activity (
-                    id,
-                    title,
-                    browserId,
-                    sessionId,
-                    url,
-                    browserHistoryId,
-                    browserVisitId,
-                    loadTime,
-                    transitionType,
-                    browserReferringVisitId,
-                    sourceId
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
+            rows.append((
                 visit["activity_id"],
                 history["title"],
                 browserId,
@@ -70,68 +81,103 @@ def add_history_list(archive, *, browserId, sessionId, historyItems):
                 visit["transition"],
                 visit["referringVisitId"],
                 sourceId))
-        archive.conn.commit()
-    c = archive.conn.cursor()
-    c.execute("""
-        UPDATE browser
-          SET
-            newestHistory = (SELECT MAX(loadTime)
-                             FROM activity WHERE browserId = ? AND browserHistoryId IS NOT NULL),
-            oldestHistory = (SELECT MIN(loadTime)
-                             FROM activity WHERE browserId = ? AND browserHistoryId IS NOT NULL)
-    """, (browserId, browserId))
+    if not rows:
+        return
+    # Visits saved before are replaced:
+    replaced = []
+    for visitIds in chunks([row[6] for row in rows], SQL_CHUNK_SIZE):
+        c.execute("""
+            SELECT id, url FROM activity WHERE browserVisitId IN (%s)
+        """ % ", ".join(["?"] * len(visitIds)), visitIds)
+        replaced.extend((row["id"], row["url"]) for row in c.fetchall())
+    c.executemany("""
+        DELETE FROM activity WHERE id = ?
+    """, [(activity_id,) for activity_id, url in replaced])
+    c.executemany("""
+        INSERT INTO activity (
+            id,
+            title,
+            browserId,
+            sessionId,
+            url,
+            browserHistoryId,
+            browserVisitId,
+            loadTime,
+            transitionType,
+            browserReferringVisitId,
+            sourceId
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    # Extends the browser's history range with this batch, instead of rescanning all its activity:
+    load_times = [row[7] for row in rows if row[7] is not None]
+    if load_times:
+        newest, oldest = max(load_times), min(load_times)
+        c.execute("""
+            UPDATE browser
+              SET
+                newestHistory = MAX(COALESCE(newestHistory, ?), ?),
+                oldestHistory = MIN(COALESCE(oldestHistory, ?), ?)
+              WHERE id = ?
+        """, (newest, newest, oldest, oldest, browserId))
+    queue_urls(archive, [(row[4], PRIORITY_HISTORY, row[7]) for row in rows])
+    changes = Changes()
+    changes.activities_removed(replaced)
+    changes.activities_added((row[0], row[4]) for row in rows)
+    changes.save(archive)
     archive.conn.commit()
 
 
+ACTIVITY_COLUMNS = """
+    id
+    browserId
+    sessionId
+    url
+    title
+    ogTitle
+    loadTime
+    unloadTime
+    transitionType
+    sourceClickText
+    sourceClickHref
+    client_redirect
+    server_redirect
+    forward_back
+    from_address_bar
+    sourceId
+    initialLoadId
+    newTab
+    activeCount
+    activeTime
+    closedReason
+    method
+    statusCode
+    contentType
+    hasSetCookie
+    hasCookie
+    copyEvents
+    formControlInteraction
+    formTextInteraction
+    isHashChange
+    maxScroll
+    documentHeight
+    hashPointsToElement
+    zoomLevel
+    canonicalUrl
+    mainFeedUrl
+    allFeeds
+""".strip().split()
+
+
 @addon
 def add_activity_list(archive, *, browserId, activityItems):
+    start = time.time()
+    rows = []
+    links = []
     for activity in activityItems:
-        c = archive.conn.cursor()
-        columns = """
-            id
-            browserId
-            sessionId
-            url
-            title
-            ogTitle
-            loadTime
-            unloadTime
-            transitionType
-            sourceClickText
-            sourceClickHref
-            client_redirect
-            server_redirect
-            forward_back
-            from_address_bar
-            sourceId
-            initialLoadId
-            newTab
-            activeCount
-            activeTime
-            closedReason
-            method
-            statusCode
-            contentType
-            hasSetCookie
-            hasCookie
-            copyEvents
-            formControlInteraction
-            formTextInteraction
-            isHashChange
-            maxScroll
-            documentHeight
-            hashPointsToElement
-            zoomLevel
-            canonicalUrl
-            mainFeedUrl
-            allFeeds
-        """.strip().split()
         for null_default in "sourceId transitionType".split():
             activity.setdefault(null_default, None)
-        marks = ["?"] * len(columns)
         activity["browserId"] = browserId
-        linkInformation = activity["linkInformation"]
-        del activity["linkInformation"]
+        linkInformation = activity.pop("linkInformation")
         if activity["copyEvents"]:
             activity["copyEvents"] = json.dumps(activity["copyEvents"])
         else:
@@ -140,30 +186,53 @@ def add_activity_list(archive, *, browserId, activityItems):
             activity["allFeeds"] = json.dumps(activity["allFeeds"])
         else:
             activity["allFeeds"] = None
-        log(archive, activity)
-        values = [activity[column] for column in columns]
-        unused = set(activity).difference(columns)
+        unused = set(activity).difference(ACTIVITY_COLUMNS)
         if unused:
             raise Exception("Unused keys in activity submission: {}".format(unused))
-        c.execute("""
-            INSERT OR REPLACE INTO activity (
-              %s
-            ) VALUES (%s)
-        """ % (", ".join(columns), ", ".join(marks)), values)
-        c.execute("""
-            DELETE FROM activity_link WHERE activity_id = ?
-        """, (activity["id"],))
+        rows.append([activity[column] for column in ACTIVITY_COLUMNS])
         for link in linkInformation or []:
-            c.execute("""
-                INSERT INTO activity_link (
-                    url,
-                    text,
-                    rel,
-                    target,
-                    elementId
-                ) VALUES (?, ?, ?, ?, ?)
-            """, (link["url"], link["text"], link.get("rel"), link.get("target"), link.get("elementId")))
+            links.append((
+                activity["id"], link["url"], link["text"], link.get("rel"), link.get("target"), link.get("elementId")))
+    c = archive.conn.cursor()
+    # Activity saved before (e.g., when it's updated as the page is unloaded) is replaced:
+    ids = [row[0] for row in rows]
+    replaced = []
+    for chunk in chunks(ids, SQL_CHUNK_SIZE):
+        c.execute("""
+            SELECT id, url FROM activity WHERE id IN (%s)
+        """ % ", ".join(["?"] * len(chunk)), chunk)
+        replaced.extend((row["id"], row["url"]) for row in c.fetchall())
+    c.executemany("""
+        INSERT OR REPLACE INTO activity (
+          %s
+        ) VALUES (%s)
+    """ % (", ".join(ACTIVITY_COLUMNS), ", ".join(["?"] * len(ACTIVITY_COLUMNS))), rows)
+    c.executemany("""
+        DELETE FROM activity_link WHERE activity_id = ?
+    """, [(activity["id"],) for activity in activityItems])
+    c.executemany("""
+        INSERT INTO activity_link (
+            activity_id,
+            url,
+            text,
+            rel,
+            target,
+            elementId
+        ) VALUES (?, ?, ?, ?, ?, ?)
+    """, links)
+    queue_urls(archive, [(activity["url"], PRIORITY_ACTIVITY, activity["loadTime"]) for activity in activityItems])
+    changes = Changes()
+    changes.activities_removed(replaced)
+    # An id that is in the list twice only has its last row:
+    changes.activities_added({row[0]: row[3] for row in rows}.items())
+    changes.save(archive)
     archive.conn.commit()
+    elapsed = time.time() - start
+    return {
+        "activities": len(rows),
+        "links": len(links),
+        "rowsPerSecond": int((len(rows) + len(links)) / elapsed) if elapsed else None,
+    }
 
 
 @addon
@@ -196,27 +265,39 @@ def register_session(archive, sessionId, browserId, timezoneOffset):
 
 @addon
 def get_needed_pages(archive, limit=100):
-    c = archive.conn.cursor()
-    rows = c.execute("""
-        SELECT history.url, fetch_error.errorMessage FROM history
-        LEFT JOIN page
-            ON page.url = history.url
-        LEFT JOIN fetch_error
-            ON fetch_error.url = history.url
-        WHERE page.url IS NULL
-        ORDER BY fetch_error.url IS NULL DESC, lastVisitTime DESC
-        LIMIT ?
-    """, (limit,))
-    return [{"url": row["url"], "lastError": row["errorMessage"]} for row in rows]
+    # Pages still queued in the page writer don't have rows yet, but aren't needed:
+    pending = archive.page_writer.pending_urls() if archive.page_writer else set()
+    with archive.lock:
+        c = archive.conn.cursor()
+        # This reads fetch_queue_next in order, skipping URLs that are waiting to be retried:
+        rows = c.execute("""
+            SELECT url, lastError FROM fetch_queue
+            WHERE nextAttempt <= ?
+            ORDER BY priority DESC, lastVisitTime DESC
+            LIMIT ?
+        """, (int(time.time() * 1000), limit + len(pending)))
+        result = [{"url": row["url"], "lastError": row["lastError"]} for row in rows if row["url"] not in pending]
+        return result[:limit]
+
+get_needed_pages.concurrent = True
 
 
 @addon
 def check_page_needed(archive, url):
-    c = archive.conn.cursor()
-    c.execute("""
-        SELECT COUNT(*) AS counter FROM page WHERE page.url = ?
-    """, (url,))
-    return not c.fetchone()[0]
+    return check_pages_needed(archive, [url])[0]
+
+check_page_needed.concurrent = True
+
+
+@addon
+def check_pages_needed(archive, urls):
+    """Returns a list of true/false for each URL: true if the page hasn't been fetched"""
+    pending = archive.page_writer.pending_urls() if archive.page_writer else set()
+    with archive.lock:
+        fetched = archive.urls_fetched(url for url in urls if url not in pending)
+    return [url not in pending and url not in fetched for url in urls]
+
+check_pages_needed.concurrent = True
 
 
 @addon
@@ -231,124 +312,238 @@ def add_fetched_page(archive, id, url, page):
     if redirectUrl:
         # Removes the YouTube start time we add
         redirectUrl = redirectUrl.replace("&start=86400", "")
-    c = archive.conn.cursor()
-    c.execute("""
-        INSERT OR REPLACE INTO page (id, url, activityId, fetched, redirectUrl, timeToFetch)
-        VALUES (?, ?, ?, CURRENT_TIMESTAMP, ?, ?)
-    """, (id, url, page.get("activityId"), redirectUrl, page["timeToFetch"]))
-    c.execute("""
-        DELETE FROM fetch_error
-        WHERE url = ?
-    """, (url,))
-    archive.conn.commit()
+    row = (id, url, page.get("activityId"), redirectUrl, page["timeToFetch"])
+    # In a batch the page is written right away: the page writer needs archive.lock to commit,
+    # and the batch holds it until it's done
+    if archive.page_writer and not archive.conn.in_batch:
+        # The page and its row are written with any others that are waiting, and the reply waits
+        # until they're committed:
+        archive.page_writer.put(row, page).result()
+        return
+    # The page is written before its row, so there's never a row without a page:
     write_page(archive, url, page)
+    with archive.lock:
+        insert_page_rows(archive, [row])
+        archive.conn.commit()
+
+add_fetched_page.concurrent = True
 
 
 @addon
 def add_fetch_failure(archive, url, errorMessage):
     c = archive.conn.cursor()
+    c.execute("""
+        SELECT 1 FROM fetch_error WHERE url = ?
+    """, (url,))
+    failed_before = c.fetchone() is not None
     c.execute("""
         INSERT OR REPLACE INTO fetch_error (url, errorMessage)
         VALUES (?, ?)
     """, (url, errorMessage))
+    # In the DO UPDATE, attempts is the number of attempts before this one:
+    now = int(time.time() * 1000)
+    c.execute("""
+        INSERT INTO fetch_queue (url, priority, attempts, nextAttempt, lastError)
+        VALUES (?, -1, 1, ?, ?)
+        ON CONFLICT (url) DO UPDATE SET
+          priority = priority - 1,
+          attempts = attempts + 1,
+          nextAttempt = ? + MIN(? << MIN(attempts, 30), ?),
+          lastError = excluded.lastError
+    """, (url, now + RETRY_DELAY, errorMessage, now, RETRY_DELAY, MAX_RETRY_DELAY))
+    if not failed_before:
+        changes = Changes()
+        changes.errors_added(1)
+        changes.save(archive)
     archive.conn.commit()
 
 
 @addon
 def status(archive, browserId):
-    c = archive.conn.cursor()
-    c.execute("""
-        SELECT
-            (SELECT COUNT(*) FROM activity) AS activity_count,
-            (SELECT newestHistory FROM browser WHERE id = ?) AS latest,
-            (SELECT oldestHistory FROM browser WHERE id = ?) AS oldest,
-            (SELECT COUNT(*) FROM page) AS fetched_count
-    """, (browserId, browserId))
-    row = c.fetchone()
-    return dict(row)
+    with archive.lock:
+        c = archive.conn.cursor()
+        c.execute("""
+            SELECT
+                (SELECT activity_count FROM archive_stats) AS activity_count,
+                (SELECT newestHistory FROM browser WHERE id = ?) AS latest,
+                (SELECT oldestHistory FROM browser WHERE id = ?) AS oldest,
+                (SELECT fetched_count FROM archive_stats) AS fetched_count
+        """, (browserId, browserId))
+        row = c.fetchone()
+        return dict(row)
+
+status.concurrent = True
 
 
 @addon
 def log(archive, *args, level='log', stack=None):
-    filename = os.path.join(archive.path, "addon.log")
-    with open(filename, "a") as fp:
-        if stack:
-            log_location = stack.splitlines()[0]
-            log_location = re.sub(r'moz-extension://[a-f0-9-]+/', '/', log_location)
-        else:
-            log_location = ""
-        print("Log/{: <5} {} {}".format(level, int(time.time() * 1000), log_location), file=fp)
-        if len(str(args)) < 70 and len(args) > 1:
-            args = (args,)
-        for arg in args:
-            if isinstance(arg, str):
-                s = arg
-            else:
-                s = pprint.pformat(arg, compact=True)
-                if isinstance(arg, tuple):
-                    s = s[1:-1]
-            s = s.splitlines()
-            for line in s:
-                print("   ", line, file=fp)
-        if not args:
-            print("    (no arguments)", file=fp)
-        print(file=fp)
+    get_log_writer(os.path.join(archive.path, "addon.log")).log(*args, level=level, stack=stack)
+
+log.concurrent = True
+
+
+@addon
+def get_metrics(archive):
+    if not metrics:
+        return None
+    return metrics.as_json()
+
+get_metrics.concurrent = True
+
+
+@addon
+def batch(archive, calls):
+    """Runs a list of calls (`{"name", "args", "kwargs"}`) in one transaction
+
+    Returns a list with `{"result": ...}` or `{"error": ..., "traceback": ...}` for each call. Each
+    call has its own savepoint, so one that fails is undone without stopping the others.
+    """
+    results = []
+    with archive.lock, archive.conn.batch():
+        for call in calls:
+            handler = message_handlers.get(call.get("name"))
+            try:
+                if not handler or handler is batch:
+                    raise Exception("Can't call %r in a batch" % call.get("name"))
+                with archive.conn.savepoint():
+                    results.append({"result": call_handler(archive, handler, call)})
+            except Exception as e:
+                tb = traceback.format_exc()
+                log(archive, "Error processing batched call %s: %s" % (describe_message(call), e), tb, level='s_err')
+                results.append({"error": str(e), "traceback": tb})
+    return results
+
+
+def queue_urls(archive, rows):
+    """Adds `(url, priority, visitTime)` rows to fetch_queue, unless they've been fetched (the caller commits)
+
+    A URL already in the queue gets the latest visit time, and the higher priority if it hasn't
+    failed yet.
+    """
+    latest = {}
+    for url, priority, visit_time in rows:
+        if url in latest:
+            old_priority, old_visit_time = latest[url]
+            priority = max(priority, old_priority)
+            if old_visit_time is not None and (visit_time is None or old_visit_time > visit_time):
+                visit_time = old_visit_time
+        latest[url] = (priority, visit_time)
+    c = archive.conn.cursor()
+    c.executemany("""
+        INSERT INTO fetch_queue (url, priority, lastVisitTime)
+        SELECT ?1, ?2, ?3
+        WHERE NOT EXISTS (SELECT 1 FROM page WHERE page.url = ?1)
+        ON CONFLICT (url) DO UPDATE SET
+          lastVisitTime = MAX(
+            COALESCE(lastVisitTime, excluded.lastVisitTime), COALESCE(excluded.lastVisitTime, lastVisitTime)),
+          priority = CASE WHEN attempts = 0 THEN MAX(priority, excluded.priority) ELSE priority END
+    """, [(url, priority, visit_time) for url, (priority, visit_time) in latest.items()])
+
+
+def chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
 
 
 def write_page(archive, url, data):
-    filename = Page.json_filename(archive, url)
-    with open(filename, "wb") as fp:
-        fp.write(json.dumps(data).encode("UTF-8"))
+    pagestore.write_page(archive, url, data)
 
 
-def run_saver(storage_directory=None):
+def run_saver(storage_directory=None, workers=4):
+    global recorder, metrics
     from . import Archive
+    recorder = recording.recorder_from_environment()
     if not storage_directory:
         archive = Archive.default_location()
     else:
         archive = Archive(storage_directory)
-    while True:
-        m_name = "(unknown)"
-        try:
-            message = get_message()
-            m_name = "%(name)s(%(args)s%(kwargs)s)" % dict(
-                name=message["name"],
-                args=", ".join(json.dumps(s) for s in message.get("args", [])),
-                kwargs=", ".join("%s=%s" % (name, json.dumps(value)) for name, value in message.get("kwargs", {}).items()),
-            )
-            if len(m_name) > 100:
-                m_name = m_name[:60] + " ... " + m_name[-10:]
-            print("Message:", m_name, file=sys.stderr)
-            handler = message_handlers.get(message["name"])
-            if not handler:
-                print("Error: got unexpected message name: %r" % message["name"], file=sys.stderr)
-                continue
+    archive.page_writer = PageWriter(archive)
+    # Reads the fetched URLs in the background; until that's done check_pages_needed looks up every URL:
+    archive.build_fetched_url_filter()
+    metrics = Metrics(os.path.join(archive.path, "metrics.json"))
+    dispatcher = Dispatcher(
+        lambda message: handle_message(archive, message),
+        is_concurrent,
+        workers=workers)
+    dispatcher.run(get_message, send_message)
+    archive.page_writer.close()
+    metrics.save()
+
+
+def is_concurrent(message):
+    return getattr(message_handlers.get(message.get("name")), "concurrent", False)
+
+
+def handle_message(archive, message):
+    """Runs the handler for the message, returning the reply (or None if there's no reply)"""
+    try:
+        if log_messages:
+            print("Message:", describe_message(message), file=sys.stderr)
+        handler = message_handlers.get(message["name"])
+        if not handler:
+            print("Error: got unexpected message name: %r" % message["name"], file=sys.stderr)
+            return None
+        result = call_handler(archive, handler, message)
+        return {"id": message["id"], "result": result}
+    except Exception as e:
+        tb = traceback.format_exc()
+        log(archive, "Error processing message %s: %s" % (describe_message(message), e), tb, level='s_err')
+        return {"id": message.get("id"), "error": str(e), "traceback": tb}
+
+
+# Made by get_message() the first time it's called:
+frame_reader = None
+
+
+def call_handler(archive, handler, message):
+    """Calls the handler with the message's arguments, and records its metrics"""
+    start = time.perf_counter()
+    outer_db_timer = start_db_timer()
+    error = True
+    try:
+        if getattr(handler, "concurrent", False):
             result = handler(archive, *message.get("args", ()), **message.get("kwargs", {}))
-            send_message({"id": message["id"], "result": result})
-        except Exception as e:
-            tb = traceback.format_exc()
-            log(archive, "Error processing message %s(): %s" % (m_name, e), tb, level='s_err')
-            send_message({"id": message["id"], "error": str(e), "traceback": tb})
+        else:
+            with archive.lock:
+                result = handler(archive, *message.get("args", ()), **message.get("kwargs", {}))
+        error = False
+    finally:
+        db_time = stop_db_timer(outer_db_timer)
+        if metrics:
+            metrics.record(message["name"], time.perf_counter() - start, db_time=db_time, error=error)
+    return result
 
 
 def get_message():
-    length = sys.stdin.buffer.read(4)
-    if len(length) == 0:
-        sys.exit(0)
-    length = struct.unpack('@I', length)[0]
-    message = sys.stdin.buffer.read(length).decode('utf-8')
-    message = json.loads(message)
+    """Reads one message from stdin, returning None when stdin is closed"""
+    global frame_reader
+    if frame_reader is None:
+        frame_reader = frames.FrameReader(sys.stdin.buffer)
+    content = frame_reader.read_frame()
+    if content is None:
+        return None
+    size = len(content)
+    if recorder:
+        recorder.record(recording.INCOMING, frames.length_struct.pack(size), content)
+    message = frames.loads_view(content)
+    if metrics:
+        metrics.message_received(message, size)
     return message
 
 
 def encode_message(message):
-    content = json.dumps(message).encode('utf-8')
-    length = struct.pack('@I', len(content))
-    return length + content
+    return frames.encode_frame(message)
 
 
 def send_message(message):
-    sys.stdout.buffer.write(encode_message(message))
+    content = frames.dumps(message)
+    header = frames.length_struct.pack(len(content))
+    if recorder:
+        recorder.record(recording.OUTGOING, header, content)
+    if metrics:
+        metrics.reply_sent(message, len(content))
+    sys.stdout.buffer.write(header)
+    sys.stdout.buffer.write(content)
     sys.stdout.buffer.flush()
 
 
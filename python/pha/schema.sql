@@ -84,3 +84,11 @@ CREATE TABLE IF NOT EXISTS activity_link (
   target TEXT,
   elementId TEXT
 );
+
+CREATE TABLE IF NOT EXISTS page_blob (
+  url TEXT PRIMARY KEY,
+  segment INT NOT NULL, -- packs/<segment>.pack
+  offset INT NOT NULL,
+  length INT NOT NULL,
+  compressed BOOLEAN DEFAULT FALSE -- zstd, see pagestore.py
+);
@@ -34,6 +34,11 @@ setup(
     packages=find_packages(include=['pha']),
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        "zstd": ["zstandard"],
+        "orjson": ["orjson"],
+        "numpy": ["numpy"],
+    },
     license="MIT license",
     zip_safe=True,
     # keywords='',
@@ -0,0 +1,114 @@
+import pha
+from pha import saver
+from pha.changes import Changes
+
+
+def make_archive(path, count=20):
+    archive = pha.Archive(str(path))
+    c = archive.conn.cursor()
+    c.execute("INSERT INTO browser (id, userAgent) VALUES ('b1', 'test')")
+    for i in range(count):
+        c.execute("""
+            INSERT INTO activity (id, browserId, url, loadTime, browserVisitId)
+            VALUES (?, 'b1', ?, ?, ?)
+        """, ("a%02i" % i, "https://example.com/%i" % i, 1000 + i, "v%i" % i))
+    c.execute("INSERT INTO activity_link (activity_id, url, text) VALUES ('a01', 'https://example.com/2', 'two')")
+    archive.conn.commit()
+    return archive
+
+
+def pool_state(pool):
+    return (
+        sorted((a.id, a.url, a.loadTime, a.browserHistoryId, a.has_page) for a in pool.activities),
+        sorted((url, sorted(link.activity.id for link in links)) for url, links in pool.link_to_url.items()),
+    )
+
+
+def save_snapshot(pool, tmp_path):
+    path = str(tmp_path / "pool.snapshot")
+    pool.save(path)
+    return path
+
+
+def test_load_unchanged(tmp_path):
+    archive = make_archive(tmp_path)
+    pool = pha.ActivityPool.for_window(archive)
+    path = save_snapshot(pool, tmp_path)
+    assert pool_state(pha.ActivityPool.load(archive, path)) == pool_state(pool)
+
+
+def test_delete_and_reinsert_at_top_rowid(tmp_path):
+    # Sending a visit again deletes its activity and inserts a new one; SQLite gives the new row
+    # the rowid the deleted one had
+    archive = make_archive(tmp_path)
+    path = save_snapshot(pha.ActivityPool.for_window(archive), tmp_path)
+    c = archive.conn.cursor()
+    old_rowid = c.execute("SELECT rowid FROM activity WHERE id = 'a19'").fetchone()[0]
+    saver.add_history_list(archive, browserId="b1", sessionId=None, historyItems={
+        "h19": {"url": "https://example.com/19", "title": "again", "visits": {
+            "v19": {"visitTime": 1019, "transition": "link", "referringVisitId": None}}},
+    })
+    (replacement,) = c.execute("SELECT id FROM activity WHERE browserVisitId = 'v19'").fetchone()
+    assert c.execute("SELECT rowid FROM activity WHERE id = ?", (replacement,)).fetchone()[0] == old_rowid
+    loaded = pha.ActivityPool.load(archive, path)
+    assert "a19" not in loaded.activities_by_id
+    assert loaded.activities_by_id[replacement].browserHistoryId == "h19"
+    assert pool_state(loaded) == pool_state(pha.ActivityPool.for_window(archive))
+
+
+def test_update_in_place(tmp_path):
+    archive = make_archive(tmp_path)
+    path = save_snapshot(pha.ActivityPool.for_window(archive), tmp_path)
+    c = archive.conn.cursor()
+    c.execute("UPDATE activity SET url = 'https://example.com/changed' WHERE id = 'a05'")
+    c.execute("DELETE FROM activity_link WHERE activity_id = 'a01'")
+    c.execute("UPDATE activity SET loadTime = loadTime WHERE id = 'a01'")
+    changes = Changes()
+    changes.activities_updated(["a05", "a01"])
+    changes.save(archive)
+    archive.conn.commit()
+    loaded = pha.ActivityPool.load(archive, path)
+    assert loaded.activities_by_id["a05"].url == "https://example.com/changed"
+    assert not loaded.link_to_url
+    assert pool_state(loaded) == pool_state(pha.ActivityPool.for_window(archive))
+
+
+def test_window_and_page_changes(tmp_path):
+    archive = make_archive(tmp_path)
+    pool = pha.ActivityPool.for_window(archive, 1005, 1015)
+    path = save_snapshot(pool, tmp_path)
+    c = archive.conn.cursor()
+    # Moves one activity out of the window, one in, and deletes one:
+    c.execute("UPDATE activity SET loadTime = 2000 WHERE id = 'a06'")
+    c.execute("UPDATE activity SET loadTime = 1010 WHERE id = 'a18'")
+    c.execute("DELETE FROM activity WHERE id = 'a07'")
+    c.execute("INSERT INTO page (id, url) VALUES ('p1', 'https://example.com/8')")
+    changes = Changes()
+    changes.activities_updated(["a06", "a18"])
+    changes.activities_removed([("a07", "https://example.com/7")])
+    changes.pages_added(["https://example.com/8"])
+    changes.save(archive)
+    archive.conn.commit()
+    loaded = pha.ActivityPool.load(archive, path)
+    assert pool_state(loaded) == pool_state(pha.ActivityPool.for_window(archive, 1005, 1015))
+    assert set(loaded.activities_by_id) == set(["a%02i" % i for i in range(5, 15) if i not in (6, 7)] + ["a18"])
+
+
+def test_rebuilds_when_archive_is_behind(tmp_path):
+    archive = make_archive(tmp_path)
+    path = save_snapshot(pha.ActivityPool.for_window(archive), tmp_path)
+    archive.conn.execute("UPDATE archive_stats SET change_seq = 0")
+    archive.conn.commit()
+    loaded = pha.ActivityPool.load(archive, path)
+    assert pool_state(loaded) == pool_state(pha.ActivityPool.for_window(archive))
+
+
+def test_rebuilds_after_unrecorded_changes(tmp_path):
+    archive = make_archive(tmp_path)
+    path = save_snapshot(pha.ActivityPool.for_window(archive), tmp_path)
+    archive.conn.execute("DELETE FROM activity WHERE id = 'a03'")
+    archive.conn.commit()
+    archive.update_status(recount=True)
+    loaded = pha.ActivityPool.load(archive, path)
+    assert "a03" not in loaded.activities_by_id
+    assert pool_state(loaded) == pool_state(pha.ActivityPool.for_window(archive))
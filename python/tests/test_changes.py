@@ -0,0 +1,81 @@
+import pha
+from pha import saver
+
+
+def stats(archive):
+    row = archive.conn.execute("""
+        SELECT activity_count, activity_url_count, fetched_count, error_count FROM archive_stats
+    """).fetchone()
+    url_stats = sorted(tuple(row) for row in archive.conn.execute("SELECT url, activities FROM activity_url_stats"))
+    return tuple(row), url_stats
+
+
+def recounted(archive):
+    from pha import migrations
+    c = archive.conn.cursor()
+    migrations.recount_stats(c)
+    result = stats(archive)
+    archive.conn.rollback()
+    return result
+
+
+def history(url, *visit_ids):
+    return {"url": url, "title": url, "visits": {
+        visit_id: {"visitTime": 1000 + i, "transition": "link", "referringVisitId": None}
+        for i, visit_id in enumerate(visit_ids)}}
+
+
+def activity(activity_id, url):
+    item = {column: None for column in saver.ACTIVITY_COLUMNS}
+    item.update(id=activity_id, url=url, loadTime=1000, linkInformation=[])
+    del item["browserId"]
+    return item
+
+
+def fetched(url):
+    return {"url": url, "timeToFetch": 10, "head": "<title>x</title>", "body": "<p>x</p>", "resources": {}}
+
+
+def test_counters_match_recount(tmp_path):
+    archive = pha.Archive(str(tmp_path))
+    saver.register_browser(archive, browserId="b1", userAgent="test")
+    saver.register_session(archive, "s1", "b1", 0)
+    saver.add_history_list(archive, browserId="b1", sessionId="s1", historyItems={
+        "h1": history("https://a.com/", "v1", "v2"),
+        "h2": history("https://b.com/", "v3"),
+    })
+    assert stats(archive) == recounted(archive)
+    # Sending visits again replaces them:
+    saver.add_history_list(archive, browserId="b1", sessionId="s1", historyItems={
+        "h2": history("https://c.com/", "v3", "v4"),
+    })
+    assert stats(archive)[0][:2] == (4, 2)
+    assert stats(archive) == recounted(archive)
+    saver.add_activity_list(archive, browserId="b1", activityItems=[
+        activity("x1", "https://a.com/"), activity("x2", "https://d.com/")])
+    # Replaced with another URL, and an id given twice:
+    saver.add_activity_list(archive, browserId="b1", activityItems=[
+        activity("x2", "https://e.com/"), activity("x3", "https://e.com/"), activity("x3", "https://f.com/")])
+    assert stats(archive)[0][:2] == (7, 4)
+    assert stats(archive) == recounted(archive)
+    saver.add_fetch_failure(archive, "https://e.com/", "timeout")
+    saver.add_fetch_failure(archive, "https://e.com/", "timeout")
+    saver.add_fetch_failure(archive, "https://f.com/", "timeout")
+    assert stats(archive)[0][3] == 2
+    saver.add_fetched_page(archive, "p1", "https://e.com/", fetched("https://e.com/"))
+    assert stats(archive)[0][2:] == (1, 1)
+    assert stats(archive) == recounted(archive)
+
+
+def test_failed_call_in_batch_leaves_counters(tmp_path):
+    archive = pha.Archive(str(tmp_path))
+    saver.register_browser(archive, browserId="b1", userAgent="test")
+    results = saver.batch(archive, [
+        {"name": "add_activity_list", "kwargs": {
+            "browserId": "b1", "activityItems": [activity("x1", "https://a.com/")]}},
+        {"name": "add_activity_list", "kwargs": {
+            "browserId": "b1", "activityItems": [activity("x2", "https://b.com/"), activity("x3", None)]}},
+    ])
+    assert "error" in results[1]
+    assert stats(archive)[0][:2] == (1, 1)
+    assert stats(archive) == recounted(archive)
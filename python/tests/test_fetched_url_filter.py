@@ -0,0 +1,27 @@
+import time
+import pha
+from pha import pagewriter
+
+
+def wait_for_filter(archive):
+    for i in range(500):
+        if archive._fetched_url_filter is not None:
+            return archive._fetched_url_filter
+        time.sleep(0.01)
+    assert False, "fetched_url_filter wasn't built"
+
+
+def test_filter_is_built_in_background(tmp_path):
+    archive = pha.Archive(str(tmp_path))
+    archive.conn.executemany("INSERT INTO page (id, url) VALUES (?, ?)", [("p1", "https://a.com/"), ("p2", "https://b.com/")])
+    archive.conn.commit()
+    # Holding the lock keeps the filter from being read until the page below is committed:
+    with archive.lock:
+        archive.build_fetched_url_filter()
+        assert archive.fetched_url_filter is None
+        assert archive.urls_fetched(["https://a.com/", "https://c.com/"]) == {"https://a.com/"}
+        pagewriter.insert_page_rows(archive, [("p3", "https://c.com/", None, None, 10)])
+        archive.conn.commit()
+    url_filter = wait_for_filter(archive)
+    assert "https://c.com/" in url_filter
+    assert archive.urls_fetched(["https://a.com/", "https://c.com/", "https://d.com/"]) == {"https://a.com/", "https://c.com/"}
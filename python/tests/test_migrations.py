@@ -0,0 +1,34 @@
+import pha
+from pha import migrations
+
+
+def test_reopen_after_interrupted_add_change_log(tmp_path):
+    # An archive where add_change_log added its column, but didn't get to record its version:
+    archive = pha.Archive(str(tmp_path))
+    version = migrations.MIGRATIONS.index(migrations.add_change_log) + 1
+    archive.conn.execute("DELETE FROM schema_version WHERE version >= ?", (version,))
+    archive.conn.commit()
+    archive.close()
+    archive = pha.Archive(str(tmp_path))
+    assert migrations.schema_version(archive.conn) == len(migrations.MIGRATIONS)
+
+
+def test_failed_migration_is_rolled_back(tmp_path):
+    archive = pha.Archive(str(tmp_path))
+
+    @migrations.migration
+    def broken(c):
+        c.execute("CREATE TABLE half_done (x)")
+        raise RuntimeError("interrupted")
+
+    try:
+        try:
+            migrations.migrate(archive.conn)
+        except RuntimeError:
+            pass
+        else:
+            assert False, "migrate() should have raised"
+    finally:
+        migrations.MIGRATIONS.remove(broken)
+    assert not archive.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'half_done'").fetchall()
+    assert migrations.schema_version(archive.conn) == len(migrations.MIGRATIONS)
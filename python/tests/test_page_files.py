@@ -0,0 +1,83 @@
+import os
+import pha
+from pha import Page, pagestore, saver
+
+
+def touch(archive, url, suffix=""):
+    filename = Page.json_filename(archive, url) + suffix
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    open(filename, "w").close()
+
+
+def test_has_page_file_without_hashing(tmp_path, monkeypatch):
+    archive = pha.Archive(str(tmp_path))
+    touch(archive, "https://a.com/?q=x y&z=%20é")
+    touch(archive, "https://b.com/", ".zst")
+    archive.refresh_page_files()
+
+    def fail(*args):
+        raise AssertionError("has_page_file worked out a filename")
+
+    monkeypatch.setattr(Page, "generate_base_filename", classmethod(fail))
+    assert archive.has_page_file("https://a.com/?q=x y&z=%20é")
+    assert archive.has_page_file("https://b.com/")
+    assert not archive.has_page_file("https://c.com/")
+
+
+def test_has_page_file_with_truncated_names(tmp_path):
+    archive = pha.Archive(str(tmp_path))
+    long_url = "https://a.com/" + "x" * 300
+    touch(archive, long_url)
+    archive.refresh_page_files()
+    assert archive.has_page_file(long_url)
+    assert not archive.has_page_file(long_url + "y")
+    # Added after the index was built:
+    saver.write_page(archive, "https://d.com/", {"url": "https://d.com/", "head": "", "body": "", "resources": {}})
+    assert archive.has_page_file("https://d.com/")
+
+
+def page(url, body):
+    return {"url": url, "head": "", "body": body, "resources": {}}
+
+
+def test_shard_pages_keeps_newer_copies(tmp_path):
+    archive = pha.Archive(str(tmp_path))
+    saver.write_page(archive, "https://a.com/", page("https://a.com/", "old"))
+    saver.write_page(archive, "https://b.com/", page("https://b.com/", "b"))
+    with open(Page.annotation_filename(archive, "https://b.com/"), "w") as fp:
+        fp.write('{"note": "b"}')
+    # A second Archive, like a saver that opened it before the migration:
+    writer = pha.Archive(str(tmp_path))
+    archive.page_layout, archive.page_layout_migrating = pagestore.LAYOUT_SHARDED, True
+    with open(os.path.join(archive.pages_path, pagestore.MIGRATING_FILENAME), "w"):
+        pass
+    with open(os.path.join(archive.pages_path, "LAYOUT"), "w") as fp:
+        fp.write(str(pagestore.LAYOUT_SHARDED))
+    # Nothing is moved yet; reads fall back to the flat copies:
+    assert pagestore.read_annotations(archive, "https://b.com/") == {"note": "b"}
+    saver.write_page(writer, "https://a.com/", page("https://a.com/", "new"))
+    assert writer.page_layout == pagestore.LAYOUT_SHARDED
+    assert pagestore.read_page(archive, "https://a.com/")["body"] == "new"
+    assert pagestore.shard_pages(archive) == 2
+    assert pagestore.read_page(archive, "https://a.com/")["body"] == "new"
+    assert pagestore.read_annotations(archive, "https://b.com/") == {"note": "b"}
+    assert [name for name in os.listdir(archive.pages_path) if name.endswith(".json")] == []
+
+
+def test_writer_moves_pages_written_during_shard_pages(tmp_path, monkeypatch):
+    archive = pha.Archive(str(tmp_path))
+    writer = pha.Archive(str(tmp_path))
+    write_file = pagestore._write_file
+
+    def migrate_meanwhile(filename, content, **kwargs):
+        # The migration runs between reading the layout and writing the file:
+        write_file(filename, content, **kwargs)
+        if filename.endswith("-page.json"):
+            monkeypatch.setattr(pagestore, "_write_file", write_file)
+            pagestore.shard_pages(archive)
+
+    monkeypatch.setattr(pagestore, "_write_file", migrate_meanwhile)
+    saver.write_page(writer, "https://a.com/", page("https://a.com/", "a"))
+    assert pagestore.read_layout(archive) == (pagestore.LAYOUT_SHARDED, False)
+    assert pagestore.read_page(archive, "https://a.com/")["body"] == "a"
+    assert os.path.exists(Page.json_filename(archive, "https://a.com/"))
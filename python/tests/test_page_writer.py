@@ -0,0 +1,37 @@
+import pytest
+import pha
+from pha import pagestore, saver
+from pha.pagewriter import PageWriter
+
+
+def fetched(url):
+    return {"url": url, "timeToFetch": 10, "head": "", "body": "<p>x</p>", "resources": {}}
+
+
+def test_reply_waits_for_commit(tmp_path):
+    archive = pha.Archive(str(tmp_path))
+    archive.page_writer = PageWriter(archive)
+    try:
+        saver.add_fetched_page(archive, "p1", "https://a.com/", fetched("https://a.com/"))
+        assert not archive.page_writer.is_pending("https://a.com/")
+        other = pha.Archive(str(tmp_path))
+        assert other.conn.execute("SELECT id FROM page WHERE url = ?", ("https://a.com/",)).fetchone()[0] == "p1"
+        assert pagestore.read_page(other, "https://a.com/")["body"] == "<p>x</p>"
+    finally:
+        archive.page_writer.close()
+
+
+def test_failed_write_is_an_error(tmp_path, monkeypatch):
+    archive = pha.Archive(str(tmp_path))
+    archive.page_writer = PageWriter(archive)
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(pagestore, "store_pages", fail)
+    try:
+        with pytest.raises(OSError):
+            saver.add_fetched_page(archive, "p1", "https://a.com/", fetched("https://a.com/"))
+        assert archive.conn.execute("SELECT COUNT(*) FROM page").fetchone()[0] == 0
+    finally:
+        archive.page_writer.close()
@@ -15,6 +15,8 @@ requirements = [
     "sqlobject",
     "colorama",
     "yarl",
+    # The connector uses pha's modules; it isn't on PyPI, so install it from python/ first:
+    "pha",
 ]
 
 setup(